@@ -1,12 +1,18 @@
 import firebase_admin.auth
 
-from firebase_admin import firestore
 from flask import abort
+from flask import g
 from flask import session
 from functools import wraps
 
+import settings
+from apps.cache import LRUCache
+
 USER_KEY = "USER"
 
+# Firebase user records, shared by requests on this instance for a short while
+_user_cache = LRUCache(settings.AUTH_USER_CACHE_SIZE, ttl=settings.AUTH_USER_CACHE_TTL)
+
 
 def session_login(user):
     """Login user.  Assumes user was authenticated!
@@ -15,13 +21,26 @@ def session_login(user):
     """
     session[USER_KEY] = user.uid
     session.permanent = True  # keep session after browser closer
+    _user_cache.set(user.uid, user)
 
 
 def session_logout():
     """Logout current user from session."""
+    invalidate_user(session[USER_KEY])
     del session[USER_KEY]
 
 
+def invalidate_user(user_uid):
+    """Forget any cached copy of a user.  Call this whenever a user is changed
+    (e.g. disabled) so the change is seen by the next request on this instance.
+
+    :param user_uid: The Firebase user's uid
+    """
+    _user_cache.pop(user_uid)
+    if g.get("authenticated_user") is not None and g.authenticated_user[0] == user_uid:
+        g.pop("authenticated_user")
+
+
 def is_authenticated():
     """Does the current session have a user?"""
     if USER_KEY in session:
@@ -32,20 +51,39 @@ def is_authenticated():
 
 
 def get_authenticated_user():
-    """Get the currently logged in user.
+    """Get the currently logged in user.  Looked up at most once per request
+    (memoized on flask.g), and served from a short-lived per-instance cache
+    across requests.
 
     :return: Firebase user object"""
-    db = firestore.client()
-
     if USER_KEY not in session:
         raise Exception("No active session")
-    else:
+
+    user_uid = session[USER_KEY]
+    memo = g.get("authenticated_user")
+    if memo is not None and memo[0] == user_uid:
+        return memo[1]
+
+    user = get_user(user_uid)
+    g.authenticated_user = (user_uid, user)
+    return user
+
+
+def get_user(user_uid):
+    """Get a Firebase user, from the short-lived per-instance cache if possible.
+
+    :param user_uid: The Firebase user's uid
+    :return: Firebase user object, or None if there is no such user
+    """
+    user = _user_cache.get(user_uid)
+    if user is None:
         try:
-            user_uid = session[USER_KEY]
             user = firebase_admin.auth.get_user(user_uid)
-            return user
         except firebase_admin.auth.AuthError as e:
-            return None
+            user = None
+        else:
+            _user_cache.set(user_uid, user)
+    return user
 
 
 def require_authenticated(function):
@@ -0,0 +1,72 @@
+import collections
+import threading
+import time
+
+
+class LRUCache:
+    """A small, thread-safe, in-process cache.  Holds at most `max_size` keys and
+    evicts the least recently used key first.  If `ttl` (in seconds) is given,
+    values older than that are treated as missing.
+
+    For values whose size varies a lot, give `max_bytes` instead (or as well)
+    with `sizeof`, a function returning the size of a value; the cache then
+    evicts until the values' total size fits.
+    """
+    def __init__(self, max_size=None, ttl=None, max_bytes=None, sizeof=len):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.total_bytes = 0
+        self._values = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                stored_at, value = self._values[key]
+            except KeyError:
+                return default
+            if self.ttl is not None and stored_at + self.ttl < time.monotonic():
+                self._remove(key)
+                return default
+            self._values.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._values:
+                self._remove(key)
+            if self.max_bytes is not None:
+                size = self.sizeof(value)
+                if size > self.max_bytes:
+                    return value
+                self.total_bytes += size
+            self._values[key] = (time.monotonic(), value)
+            while (self.max_size is not None and len(self._values) > self.max_size) or \
+                    (self.max_bytes is not None and self.total_bytes > self.max_bytes):
+                self._remove(next(iter(self._values)))
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._values:
+                return default
+            return self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.total_bytes = 0
+
+    def _remove(self, key):
+        stored_at, value = self._values.pop(key)
+        if self.max_bytes is not None:
+            self.total_bytes -= self.sizeof(value)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._values)
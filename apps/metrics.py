@@ -0,0 +1,157 @@
+import collections
+import contextlib
+import json
+import logging
+import sys
+import threading
+import time
+from flask import request
+from functools import wraps
+
+import settings
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+if not logger.handlers:
+    # App Engine turns JSON lines on stdout into structured log entries
+    _handler = logging.StreamHandler(sys.stdout)
+    logger.addHandler(_handler)
+    logger.propagate = False
+
+_local = threading.local()
+
+
+def _new_stage():
+    return {"count": 0, "seconds": 0.0, "bytes": 0}
+
+
+class TaskMetrics:
+    """Time spent, bytes moved and operations made by one task invocation,
+    by stage (e.g. "podcast.load_feed" or "firestore.commit").  Stages nest,
+    so a stage's time includes the stages it called.
+    """
+    def __init__(self, task):
+        self.task = task
+        self.started = time.time()
+        self.seconds = None
+        self.stages = collections.defaultdict(_new_stage)
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds=0.0, bytes_=0, count=1):
+        with self._lock:
+            totals = self.stages[stage]
+            totals["count"] += count
+            totals["seconds"] += seconds
+            totals["bytes"] += bytes_
+
+    def to_dict(self):
+        with self._lock:
+            return {"task": self.task,
+                    "started": self.started,
+                    "seconds": self.seconds,
+                    "stages": {stage: dict(totals) for stage, totals in self.stages.items()}}
+
+
+class MetricsRegistry:
+    """Totals of the task invocations handled by this instance, plus the most
+    recent invocations themselves."""
+    def __init__(self, recent_size):
+        self._totals = {}
+        self._recent = collections.deque(maxlen=recent_size)
+        self._lock = threading.Lock()
+
+    def add(self, metrics):
+        invocation = metrics.to_dict()
+        with self._lock:
+            self._recent.append(invocation)
+            totals = self._totals.setdefault(metrics.task, {"count": 0, "seconds": 0.0, "max_seconds": 0.0,
+                                                            "stages": collections.defaultdict(_new_stage)})
+            totals["count"] += 1
+            totals["seconds"] += invocation["seconds"]
+            totals["max_seconds"] = max(totals["max_seconds"], invocation["seconds"])
+            for stage, stage_totals in invocation["stages"].items():
+                for name, value in stage_totals.items():
+                    totals["stages"][stage][name] += value
+
+    def to_dict(self):
+        with self._lock:
+            return {"tasks": {task: dict(totals, stages=dict(totals["stages"]))
+                              for task, totals in self._totals.items()},
+                    "recent": list(self._recent)}
+
+
+registry = MetricsRegistry(settings.METRICS_RECENT_TASKS)
+
+
+def current_metrics():
+    """The TaskMetrics of the task running on this thread, or None."""
+    return getattr(_local, "metrics", None)
+
+
+@contextlib.contextmanager
+def use_metrics(metrics):
+    """Record into `metrics` on this thread, e.g. in a worker thread of a task."""
+    previous = current_metrics()
+    _local.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _local.metrics = previous
+
+
+def count(operation, amount=1, bytes_=0):
+    """Count an operation (e.g. an RPC) against the running task, if any."""
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.record(operation, bytes_=bytes_, count=amount)
+
+
+def timed(stage, size=None):
+    """DECORATOR function.  Record the duration of each call against the
+    running task, if any.
+
+    :param stage: Name the calls are recorded under
+    :param size: Optional function of the return value giving the bytes moved
+    :return: The decorator
+    """
+    def decorator(function):
+        @wraps(function)
+        def decorated_function(*args, **kwargs):
+            metrics = current_metrics()
+            if metrics is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            bytes_ = 0
+            try:
+                result = function(*args, **kwargs)
+                if size is not None:
+                    bytes_ = size(result) or 0
+                return result
+            finally:
+                metrics.record(stage, time.perf_counter() - start, bytes_)
+        return decorated_function
+    return decorator
+
+
+def instrument_task(function):
+    """DECORATOR function.  Collect the metrics of each invocation of a task
+    view, log them as one structured line and add them to the registry.
+
+    :param function: The task view
+    :return: The decorated function
+    """
+    @wraps(function)
+    def decorated_function(*args, **kwargs):
+        metrics = TaskMetrics(request.endpoint)
+        start = time.perf_counter()
+        try:
+            with use_metrics(metrics):
+                return function(*args, **kwargs)
+        finally:
+            metrics.seconds = time.perf_counter() - start
+            registry.add(metrics)
+            logger.info(json.dumps(dict(metrics.to_dict(), severity="INFO",
+                                        message=f"""task metrics: {metrics.task}""")))
+
+    return decorated_function
@@ -1,4 +1,2 @@
-from .podcast import Podcast, PodcastParserException
-
-
-
+from .podcast import Podcast, PodcastParserException, PodcastNotFound
+from .parser import FeedNotModified
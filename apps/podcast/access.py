@@ -0,0 +1,100 @@
+import atexit
+import datetime
+import threading
+import time
+from firebase_admin import firestore
+from google.api_core.exceptions import NotFound
+
+import settings
+from apps.cache import LRUCache
+from .podcast import Podcast, FIRESTORE_BATCH_LIMIT
+
+
+class AccessTracker:
+    """Collects feed hits in process and persists `last_accessed` lazily.  A
+    podcast's timestamp is only written once it has moved by more than
+    `granularity`, and pending writes are flushed together as field-level
+    updates in batched writes.
+    """
+    def __init__(self, granularity, flush_interval, batch_size, max_tracked=10000):
+        self.granularity = granularity
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._persisted = LRUCache(max_tracked)
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, user_uid, podcast_id, last_accessed=None, accessed=None):
+        """Record a hit on a podcast feed.
+
+        :param user_uid: Owner of the podcast
+        :param podcast_id: Podcast that was accessed
+        :param last_accessed: The stored last_accessed, if the caller already read it
+        :param accessed: datetime of this hit (defaults to now)
+        """
+        if accessed is None:
+            accessed = datetime.datetime.utcnow()
+        key = (user_uid, podcast_id)
+
+        with self._lock:
+            persisted = self._persisted.get(key, last_accessed)
+            if last_accessed is not None and persisted is not None:
+                persisted = max(persisted, last_accessed)
+            if persisted is not None and accessed - persisted < self.granularity:
+                return
+            self._pending[key] = accessed
+            due = len(self._pending) >= self.batch_size or \
+                time.monotonic() - self._last_flush >= self.flush_interval
+
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Write all pending last_accessed times to Firestore."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+
+        db = firestore.client()
+        items = list(pending.items())
+        for i in range(0, len(items), FIRESTORE_BATCH_LIMIT):
+            chunk = items[i:i + FIRESTORE_BATCH_LIMIT]
+            batch = db.batch()
+            for (user_uid, podcast_id), accessed in chunk:
+                batch.update(self._document(user_uid, podcast_id), {"last_accessed": accessed.timestamp()})
+            try:
+                batch.commit()
+            except NotFound:
+                # one of the podcasts was deleted since it was polled.  the batch is
+                # atomic, so find which still exist (in one read) and write those.
+                references = [self._document(user_uid, podcast_id) for (user_uid, podcast_id), _ in chunk]
+                existing = {document.reference.path
+                            for document in db.get_all(references, field_paths=["id"]) if document.exists}
+                if not existing:
+                    continue
+                batch = db.batch()
+                for reference, (_, accessed) in zip(references, chunk):
+                    if reference.path in existing:
+                        batch.update(reference, {"last_accessed": accessed.timestamp()})
+                try:
+                    batch.commit()
+                except NotFound:
+                    # deleted between the read and the write; these hits no longer matter
+                    continue
+
+        for key, accessed in items:
+            self._persisted.set(key, accessed)
+
+    @staticmethod
+    def _document(user_uid, podcast_id):
+        return Podcast.get_user_podcasts_collection(user_uid).document(podcast_id)
+
+
+access_tracker = AccessTracker(
+    granularity=datetime.timedelta(minutes=settings.ACCESS_TRACKING_GRANULARITY_MINUTES),
+    flush_interval=settings.ACCESS_FLUSH_INTERVAL_SECONDS,
+    batch_size=settings.ACCESS_FLUSH_BATCH_SIZE)
+atexit.register(access_tracker.flush)
@@ -1,8 +1,12 @@
-import hashlib
+import requests
 import youtube_dl
 
 import settings
-from .utils import stream_upload
+from apps.metrics import timed
+from .format_cache import format_cache, ResolvedFormat
+from .media import MediaIndex
+from .storage import get_storage
+from .utils import RESUMABLE_ENGINE
 
 
 class DownloadException(Exception):
@@ -10,32 +14,66 @@ class DownloadException(Exception):
 
 
 class Downloader:
+    # upload engine used by stream_upload on Cloud Storage (None uses STREAM_UPLOAD_ENGINE)
+    UPLOAD_ENGINE = None
+
     @classmethod
     def transform_source_url(cls, url):
         return url
 
     @classmethod
-    def create_destination_path(cls, source_url):
-        destination_name = hashlib.sha512(source_url.encode()).hexdigest()
+    def invalidate_source_url(cls, url):
+        """Forget any cached result of transform_source_url for `url`."""
+        pass
+
+    @classmethod
+    def create_destination_path(cls, media_key):
+        destination_name = media_key
         destination_path = f"""{settings.PODCAST_STORAGE_DIRECTORY}/{destination_name}"""
         return destination_path
 
     @classmethod
     def stream_download(cls, source_url, destination_path):
-        return stream_upload(source_url, destination_path, tmp_path=settings.PODCAST_TMP_STORAGE_DIRECTORY)
+        return get_storage().store(source_url, destination_path, engine=cls.UPLOAD_ENGINE)
 
     @classmethod
-    def download(cls, url):
-        """Downloads function at URL and then stores it publicly in our bucket.
+    @timed("downloader.download", size=lambda media: media.size)
+    def download(cls, url, reference):
+        """Downloads function at URL and then stores it publicly (see STORAGE_BACKEND).
+        If this media was already downloaded (e.g. for another user following the
+        same channel) the stored copy is reused instead.
 
         :param url: Location of file
-        :return: The blob object of where the file is stored in Cloud Storage
+        :param reference: The feed entry the file is for (see MediaIndex.reference)
+        :return: StoredMedia describing where the file is stored
         """
+        media_key = MediaIndex.media_key(cls, url)
+        # raises MediaDownloading while another entry is downloading the same media
+        media = MediaIndex.acquire(media_key, reference)
+        if media is not None:
+            return media
+
+        destination_path = cls.create_destination_path(media_key)
+        try:
+            media = cls._stream_download_retrying(url, destination_path)
+        except Exception:
+            MediaIndex.abandon(media_key, reference)
+            raise
+        MediaIndex.register(media_key, media, reference)
+        return media
+
+    @classmethod
+    def _stream_download_retrying(cls, url, destination_path):
         transformed_url = cls.transform_source_url(url)
-        destination_path = cls.create_destination_path(transformed_url)
-        blob = cls.stream_download(transformed_url, destination_path)
-        blob.make_public()
-        return blob
+        try:
+            return cls.stream_download(transformed_url, destination_path)
+        except requests.HTTPError as e:
+            # a cached source URL may have been revoked before it expired; resolve once more
+            if e.response is None or e.response.status_code != 403:
+                raise
+            cls.invalidate_source_url(url)
+            transformed_url = cls.transform_source_url(url)
+            return cls.stream_download(transformed_url, destination_path)
 
 
 class YoutubeDownloader(Downloader):
@@ -43,6 +81,26 @@ class YoutubeDownloader(Downloader):
 
     @classmethod
     def transform_source_url(cls, url):
+        return cls.resolve_format(url).url
+
+    @classmethod
+    def invalidate_source_url(cls, url):
+        format_cache.invalidate(format_cache.key(cls, url))
+
+    @classmethod
+    @timed("youtube.resolve_format")
+    def resolve_format(cls, url):
+        """Pick the format to download for a video.  Reuses the signed URL of an
+        earlier resolution until shortly before it expires.
+
+        :param url: Link of the video
+        :return: ResolvedFormat
+        """
+        key = format_cache.key(cls, url)
+        resolved = format_cache.get(key)
+        if resolved is not None:
+            return resolved
+
         with youtube_dl.YoutubeDL({'outtmpl': '%(id)s%(ext)s'}) as ydl:
             result = ydl.extract_info(url, download=False)
 
@@ -57,7 +115,9 @@ class YoutubeDownloader(Downloader):
             file = [o for o in video["formats"] if int(o["format_id"]) in cls.VALID_ITAGS].pop(0)
         except IndexError:
             raise DownloadException("Could not find a valid video URL")
-        return file["url"]
+        return format_cache.set(key, ResolvedFormat(itag=int(file["format_id"]),
+                                                    url=file["url"],
+                                                    expire=format_cache.url_expiry(file["url"])))
 
 
 class YoutubeAudioDownloader(YoutubeDownloader):
@@ -65,4 +125,6 @@ class YoutubeAudioDownloader(YoutubeDownloader):
 
 
 class YoutubeVideoDownloader(YoutubeDownloader):
+    # videos are large; one resumable session avoids hundreds of parts and composes
+    UPLOAD_ENGINE = RESUMABLE_ENGINE
     VALID_ITAGS = [18, 22, 37, 43, 44, 45]
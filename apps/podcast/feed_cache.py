@@ -0,0 +1,67 @@
+import hashlib
+
+import settings
+from apps.cache import LRUCache
+from .podcast import Podcast
+
+
+# (last_updated, rendered RSS) by podcast, bounded by the renderings' total size
+_rendered_feeds = LRUCache(max_bytes=settings.RSS_CACHE_BYTES, sizeof=lambda cached: len(cached[1]))
+
+
+def feed_etag(user_uid, podcast_id, last_updated, limit=None):
+    """Entity tag for a rendered feed.  Changes whenever the feed's
+    `last_updated` does.
+
+    :param user_uid: Owner of the podcast
+    :param podcast_id: Podcast being rendered
+    :param last_updated: The feed's last_updated datetime
+    :param limit: The number of entries rendered, if limited
+    :return: An ETag string (without quotes)
+    """
+    key = f"""{user_uid}/{podcast_id}/{last_updated.timestamp()}/{limit}"""
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def get_rendered_feed(user_uid, podcast_id, last_updated, limit=None):
+    """Get the RSS body for a podcast.  A whole feed smaller than
+    RSS_CACHE_MAX_FEED_BYTES is cached until the feed is updated; other
+    renderings are streamed (from cached <item>s, see Feed.generate_rss).
+
+    :param user_uid: Owner of the podcast
+    :param podcast_id: Podcast being rendered
+    :param last_updated: The feed's current last_updated datetime
+    :param limit: If given, only the newest `limit` entries are rendered
+    :return: The rendered RSS, as an iterable of strings
+    """
+    key = (user_uid, podcast_id)
+    if limit is None:
+        cached = _rendered_feeds.get(key)
+        if cached is not None and cached[0] >= last_updated:
+            return [cached[1]]
+
+    podcast = Podcast.load(user_uid, podcast_id)
+    if limit is not None:
+        return podcast.feed.generate_rss(limit)
+    return _render_and_cache(key, podcast.feed)
+
+
+def _render_and_cache(key, feed):
+    """Stream a feed's RSS, keeping a copy in the cache if it's small enough."""
+    rendered = []
+    size = 0
+    for chunk in feed.generate_rss():
+        yield chunk
+        if rendered is not None:
+            size += len(chunk)
+            if size <= settings.RSS_CACHE_MAX_FEED_BYTES:
+                rendered.append(chunk)
+            else:
+                rendered = None
+    if rendered is not None:
+        _rendered_feeds.set(key, (feed.last_updated, "".join(rendered)))
+
+
+def invalidate_rendered_feed(user_uid, podcast_id):
+    """Drop any cached rendering of this podcast (e.g. on delete)."""
+    _rendered_feeds.pop((user_uid, podcast_id))
@@ -0,0 +1,75 @@
+import collections
+import datetime
+import hashlib
+import urllib.parse
+from firebase_admin import firestore
+
+import settings
+from apps.cache import LRUCache
+
+
+FORMAT_COLLECTION = "youtube-formats"
+
+ResolvedFormat = collections.namedtuple("ResolvedFormat", "itag url expire")
+
+
+class FormatCache:
+    """Remembers which format (and signed media URL) was chosen for a video, so
+    youtube-dl's extraction isn't redone for every download, retry or backfill.
+    Entries are kept in memory and in Firestore, and are used until shortly
+    before the `expire` time signed into the URL.
+    """
+    def __init__(self, max_size=1024):
+        self._formats = LRUCache(max_size)
+
+    @staticmethod
+    def key(downloader, video_url):
+        """Cache key of a video for a downloader (i.e. a set of valid formats)."""
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(video_url).query)
+        video_id = query["v"][0] if "v" in query else video_url
+        return hashlib.sha1(f"""{downloader.__name__}:{video_id}""".encode()).hexdigest()
+
+    @staticmethod
+    def url_expiry(url):
+        """When a signed media URL stops working.  googlevideo URLs carry it as
+        the `expire` parameter; otherwise assume YOUTUBE_FORMAT_DEFAULT_TTL."""
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+        if "expire" in query and query["expire"][0].isdigit():
+            return datetime.datetime.utcfromtimestamp(int(query["expire"][0]))
+        return datetime.datetime.utcnow() + datetime.timedelta(seconds=settings.YOUTUBE_FORMAT_DEFAULT_TTL)
+
+    def get(self, key):
+        """A cached format that is still usable, or None."""
+        resolved = self._formats.get(key)
+        if resolved is None:
+            document = self._document(key).get()
+            if not document.exists:
+                return None
+            format_dict = document.to_dict()
+            resolved = ResolvedFormat(itag=format_dict["itag"],
+                                      url=format_dict["url"],
+                                      expire=datetime.datetime.fromtimestamp(format_dict["expire"]))
+            self._formats.set(key, resolved)
+
+        margin = datetime.timedelta(seconds=settings.YOUTUBE_FORMAT_EXPIRY_MARGIN)
+        if resolved.expire - margin <= datetime.datetime.utcnow():
+            return None
+        return resolved
+
+    def set(self, key, resolved):
+        self._formats.set(key, resolved)
+        self._document(key).set({"itag": resolved.itag,
+                                 "url": resolved.url,
+                                 "expire": resolved.expire.timestamp()})
+        return resolved
+
+    def invalidate(self, key):
+        self._formats.pop(key)
+        self._document(key).delete()
+
+    @staticmethod
+    def _document(key):
+        return firestore.client().collection(FORMAT_COLLECTION).document(key)
+
+
+format_cache = FormatCache()
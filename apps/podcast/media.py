@@ -0,0 +1,156 @@
+import collections
+import datetime
+import hashlib
+from firebase_admin import firestore
+
+import settings
+
+
+MEDIA_COLLECTION = "media"
+
+# status of a media record
+DOWNLOADING = "downloading"
+STORED = "stored"
+
+StoredMedia = collections.namedtuple("StoredMedia", "path public_url size content_type")
+
+
+class MediaDownloading(Exception):
+    """Raised when another task is downloading the same media; try again later."""
+    pass
+
+
+class MediaIndex:
+    """Index of the media we have downloaded, keyed by a stable identity (the
+    original link plus the downloader that fetched it, i.e. the format).  Each
+    record counts the feed entries that use it, so one copy can be shared
+    between podcasts and users and is only deleted once nothing refers to it.
+
+    A download first claims its key (status "downloading", with the entry that
+    owns the claim), so two entries sharing media never download it at once.
+    """
+    @classmethod
+    def media_key(cls, downloader, url):
+        """Stable identity of a piece of media.
+
+        :param downloader: Downloader class used to fetch it
+        :param url: The original (untransformed) link of the entry
+        :return: hex digest
+        """
+        return hashlib.sha512(f"""{downloader.__name__}:{url}""".encode()).hexdigest()
+
+    @classmethod
+    def reference(cls, user_uid, podcast_id, entry_id):
+        """How a feed entry refers to the media it uses."""
+        return f"""{user_uid}/{podcast_id}/{entry_id}"""
+
+    @classmethod
+    def acquire(cls, key, reference):
+        """Look up media we already have, adding `reference` to its users, or
+        claim the key so the caller downloads it.  Claims older than
+        PODCAST_DOWNLOAD_STALE_HOURS are assumed abandoned and taken over.
+
+        :param key: media_key of the media
+        :param reference: The feed entry that will use it
+        :return: StoredMedia, or None if the caller now owns the download
+        :raises MediaDownloading: if another entry is downloading it
+        """
+        db = firestore.client()
+        document = cls.get_collection().document(key)
+
+        @firestore.transactional
+        def run(transaction):
+            now = datetime.datetime.utcnow()
+            snapshot = document.get(transaction=transaction)
+            media_dict = snapshot.to_dict() if snapshot.exists else None
+            if media_dict is not None and media_dict.get("status", STORED) == STORED:
+                transaction.update(document, {"references": firestore.ArrayUnion([reference])})
+                return cls._to_stored_media(media_dict)
+            if media_dict is not None and media_dict["owner"] != reference and \
+                    datetime.datetime.fromtimestamp(media_dict["claimed_at"]) + \
+                    datetime.timedelta(hours=settings.PODCAST_DOWNLOAD_STALE_HOURS) > now:
+                raise MediaDownloading(key)
+            transaction.set(document, {"status": DOWNLOADING,
+                                       "owner": reference,
+                                       "claimed_at": now.timestamp(),
+                                       "references": []})
+            return None
+
+        return run(db.transaction())
+
+    @classmethod
+    def register(cls, key, media, reference):
+        """Record newly downloaded media, completing the claim made by acquire.
+
+        :param key: media_key of the media
+        :param media: StoredMedia describing where it was stored
+        :param reference: The feed entry that uses it
+        """
+        document = cls.get_collection().document(key)
+        document.set({"status": STORED,
+                      "path": media.path,
+                      "public_url": media.public_url,
+                      "size": media.size,
+                      "content_type": media.content_type,
+                      "references": firestore.ArrayUnion([reference])}, merge=True)
+
+    @classmethod
+    def abandon(cls, key, reference):
+        """Give up the claim on a download that failed, so another entry can
+        try straight away.
+
+        :param key: media_key of the media
+        :param reference: The feed entry that claimed it
+        """
+        db = firestore.client()
+        document = cls.get_collection().document(key)
+
+        @firestore.transactional
+        def run(transaction):
+            snapshot = document.get(transaction=transaction)
+            media_dict = snapshot.to_dict() if snapshot.exists else {}
+            if media_dict.get("status") == DOWNLOADING and media_dict.get("owner") == reference:
+                transaction.delete(document)
+
+        run(db.transaction())
+
+    @classmethod
+    def release(cls, key, reference):
+        """Drop `reference` from the users of some media.
+
+        :param key: media_key of the media
+        :param reference: The feed entry that no longer uses it
+        :return: True if nothing uses the media any more (so it should be deleted)
+        """
+        db = firestore.client()
+        document = cls.get_collection().document(key)
+
+        @firestore.transactional
+        def run(transaction):
+            snapshot = document.get(transaction=transaction)
+            if not snapshot.exists:
+                # downloaded before the index existed; nothing else can share it
+                return True
+            if snapshot.to_dict().get("status", STORED) == DOWNLOADING:
+                # being downloaded again; the file is needed
+                return False
+            references = [r for r in snapshot.get("references") if r != reference]
+            if references:
+                transaction.update(document, {"references": references})
+                return False
+            transaction.delete(document)
+            return True
+
+        return run(db.transaction())
+
+    @classmethod
+    def get_collection(cls):
+        db = firestore.client()
+        return db.collection(MEDIA_COLLECTION)
+
+    @staticmethod
+    def _to_stored_media(media_dict):
+        return StoredMedia(path=media_dict["path"],
+                           public_url=media_dict["public_url"],
+                           size=media_dict["size"],
+                           content_type=media_dict["content_type"])
@@ -1,22 +1,118 @@
+import datetime
 import feedparser
 import re
 import urllib.parse
 import urllib.request
 
+import settings
+
+
+class FeedNotModified(Exception):
+    """Raised by a conditional parse when the upstream feed hasn't changed."""
+    pass
+
 
 class Parser:
     """
     any instantiations MUST conform to the feedparser structure in returning parsed data
+
+    `state` is persisted with the podcast between parses.  It holds the upstream
+    validators (ETag / Last-Modified) used for conditional fetches.
     """
-    def parse_url(self, url):
-        """Parse a URL and return a list of dictionaries representing the feed."""
-        return feedparser.parse(url)
+    # whether entry links point at the media itself, so probing them gives its size and type
+    PROBE_ENCLOSURES = True
+
+    def __init__(self, state=None):
+        self.state = dict(state) if state else {}
+
+    def parse_url(self, url, conditional=False):
+        """Parse a URL and return a list of dictionaries representing the feed.
+
+        :param url: Location of the feed
+        :param conditional: If True, raise FeedNotModified when the upstream server
+                            says the feed hasn't changed since the last parse.
+        """
+        return self._fetch(url, conditional)
+
+    def _fetch(self, url, conditional):
+        if conditional:
+            feed = feedparser.parse(url, etag=self.state.get("etag"), modified=self.state.get("modified"))
+        else:
+            feed = feedparser.parse(url)
+        if feed.get("status") == 304:
+            raise FeedNotModified(url)
+        self.state["etag"] = feed.get("etag")
+        self.state["modified"] = feed.get("modified")
+        return feed
+
+    VALIDATORS = ("etag", "modified")
+
+    def forget_validators(self):
+        """Drop the ETag / Last-Modified of the last parse, so the next conditional
+        parse fetches the whole feed.  For parses whose entries weren't stored."""
+        for key in self.VALIDATORS:
+            self.state.pop(key, None)
+
+    def restore_validators(self, state):
+        """Put back the ETag / Last-Modified of an earlier state, keeping anything
+        else this parse refreshed.  For parses whose entries couldn't be built."""
+        self.forget_validators()
+        self.state.update({key: state[key] for key in self.VALIDATORS if key in state})
 
 
 class YoutubeParser(Parser):
+    """Parses a channel from its RSS feed, which lists the videos, their dates and
+    thumbnails in a single fetch.  Entry links are watch pages, so they aren't
+    probed; the downloader finds the size and type of the chosen format.
+    """
+    PROBE_ENCLOSURES = False
     CHANNEL_RSS_URL_TEMPLATE = "https://www.youtube.com/feeds/videos.xml?channel_id={}"
+    CHANNEL_ID_PATTERN = re.compile(r"""youtube\.com/channel/(UC[\w-]+)""")
 
-    def parse_url(self, url):
+    def parse_url(self, url, conditional=False):
+        channel_id, image_url = self._get_channel(url)
+        rss_url = self.CHANNEL_RSS_URL_TEMPLATE.format(channel_id)
+        feed = self._fetch(rss_url, conditional)
+        feed["feed"]["description"] = f"""Channel for {feed["feed"]["author"]}"""
+        if image_url is None:
+            # no channel artwork; use the latest video's thumbnail
+            thumbnails = feed["entries"][0].get("media_thumbnail", []) if feed["entries"] else []
+            image_url = thumbnails[0]["url"] if thumbnails else None
+        feed["feed"]["image"] = {"href": image_url}
+        return feed
+
+    def _get_channel(self, url):
+        """The channel id and image, re-scraped from the channel page only when
+        the cached copy is older than YOUTUBE_CHANNEL_RESCRAPE_DAYS.
+
+        Channel URLs that include the channel id still work when the page can't
+        be scraped; the image is None then.
+
+        :param url: The channel page
+        :return: tuple of (channel_id, image_url)
+        """
+        scraped = self.state.get("channel_scraped")
+        if self.state.get("channel_url") == url and scraped is not None and \
+                datetime.datetime.fromtimestamp(scraped) + \
+                datetime.timedelta(settings.YOUTUBE_CHANNEL_RESCRAPE_DAYS) > datetime.datetime.utcnow():
+            return self.state["channel_id"], self.state["image_url"]
+
+        url_match = self.CHANNEL_ID_PATTERN.search(url)
+        try:
+            channel_id, image_url = self._scrape_channel(url)
+        except Exception:
+            if url_match is None:
+                raise
+            channel_id, image_url = url_match.group(1), None
+
+        self.state.update({"channel_url": url,
+                           "channel_id": channel_id,
+                           "image_url": image_url,
+                           "channel_scraped": datetime.datetime.utcnow().timestamp()})
+        return channel_id, image_url
+
+    @staticmethod
+    def _scrape_channel(url):
         with urllib.request.urlopen(url) as response:
             content = response.read().decode("utf-8")
             search_results = re.search(r'''externalId":"([^"]+)"''', content)
@@ -26,11 +122,7 @@ class YoutubeParser(Parser):
                 raise Exception("Couldn't find Youtube external URL")
 
             channel_id = search_results.groups()[0]
-            rss_url = self.CHANNEL_RSS_URL_TEMPLATE.format(channel_id)
 
             search_results = re.search(r'''<meta property="og:image" content="([^"]+)"''', content)
-            image_url = search_results.groups()[0]
-        feed = feedparser.parse(rss_url)
-        feed["feed"]["description"] = f"""Channel for {feed["feed"]["author"]}"""
-        feed["feed"]["image"] = {"href": image_url}
-        return feed
+            image_url = search_results.groups()[0] if search_results is not None else None
+        return channel_id, image_url
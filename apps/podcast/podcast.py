@@ -1,20 +1,71 @@
+import array
+import bisect
+import collections
 import datetime
 import email.utils
-import urllib.request
-from flask import request, url_for, render_template
+import hashlib
+import itertools
+from flask import current_app, request, url_for, Markup
 from firebase_admin import firestore
 from uuid import uuid4
+
+import settings
+from apps.cache import LRUCache
+from apps.metrics import count, timed
+from .prober import EnclosureProber, UNKNOWN_ENCLOSURE
 from .type import PODCAST_TYPES
 
 
 USER_PODCAST_COLLECTION = "users-podcasts"
 PODCAST_COLLECTION = "podcasts"
+ENTRY_COLLECTION = "entries"
+PENDING_COLLECTION = "pending"
+
+# Firestore rejects batched writes with more operations than this.
+FIRESTORE_BATCH_LIMIT = 500
+
+# what listing a user's podcasts reads of each one
+PodcastSummary = collections.namedtuple("PodcastSummary", "id user_uid podcast_type url title image_url")
+SUMMARY_FIELDS = ["id", "user_uid", "podcast_type", "url", "feed.title", "feed.image_url"]
+
+# rendered <item> of each entry, keyed by its contents
+_rss_items = LRUCache(max_bytes=settings.RSS_ITEM_CACHE_BYTES)
 
 
 class PodcastParserException(Exception):
     pass
 
 
+class PodcastNotFound(Exception):
+    pass
+
+
+def write_in_batches(writes):
+    """Apply writes using as few batched writes as Firestore allows.
+
+    :param writes: iterable of (document reference, dict to set or None to delete)
+    """
+    db = firestore.client()
+    batch = db.batch()
+    operations = 0
+    for reference, data in writes:
+        if data is None:
+            batch.delete(reference)
+        else:
+            batch.set(reference, data)
+        operations += 1
+        if operations == FIRESTORE_BATCH_LIMIT:
+            batch.commit()
+            count("firestore.commit")
+            count("firestore.write", operations)
+            batch = db.batch()
+            operations = 0
+    if operations:
+        batch.commit()
+        count("firestore.commit")
+        count("firestore.write", operations)
+
+
 class Podcast:
     """Class represents a podcast as a name, description, and other parameters.  Becomes the
     base object for all podcasts.  Additionally, provides class and static methods for working
@@ -27,22 +78,53 @@ class Podcast:
         self.podcast_type = podcast_type
         self.url = url
         self.last_accessed = None
+        # parser state persisted between parses (e.g. upstream ETag / Last-Modified)
+        self.parser_state = {}
+        # refresh scheduling (see schedule.py)
+        self.next_check_at = None
+        self.unchanged_count = 0
+        self.failure_count = 0
+        # new entries waiting to be downloaded, oldest first.  The entries themselves
+        # are kept in their own subcollection; unsaved changes to it are remembered here.
+        self.pending = []
+        self._pending_entries = {}
+        self._dropped_pending = set()
 
     def initialize(self):
+        """Parse the podcast's URL and start a new, empty feed from it.  The
+        entries of a feed being replaced are deleted when the podcast is saved;
+        release their media (see release_entries_media) after that.
+
+        :return: list of the FeedEntry objects of the replaced feed
+        """
         parser = PODCAST_TYPES[self.podcast_type].parser()
         try:
             if self.id is None:
                 self.id = str(uuid4())
             feed = parser.parse_url(self.url)
+            # the entries of this parse are planned by the first refresh, which must
+            # not be told "not modified"; only cached channel info is kept
+            parser.forget_validators()
+            self.parser_state = parser.state
+            stale_entries = list(self.feed.iter_entries()) if self.feed is not None else []
             self.feed = Feed(user_uid=self.user_uid,
                              podcast_id=self.id,
                              title=feed["feed"]["title"],
                              description=feed["feed"]["description"],
                              image_url=feed["feed"]["image"]["href"],
                              last_updated=datetime.datetime.utcnow())
+            # entries of the feed being replaced are deleted when this is saved
+            self.feed.discard(entry.id for entry in stale_entries)
+            # so are downloads queued from the old feed
+            self._drop_pending([pending.entry_id for pending in self.pending])
             self.last_accessed = datetime.datetime.utcnow()
+            # a new (or changed) podcast is refreshed right away
+            self.next_check_at = datetime.datetime.utcnow()
+            self.unchanged_count = 0
+            self.failure_count = 0
         except Exception:
             raise PodcastParserException(f"""Could not parse podcast ({self.url}, {self.podcast_type})""")
+        return stale_entries
 
     def __hash__(self):
         return hash(self.id)
@@ -54,38 +136,130 @@ class Podcast:
         return not (self == other)
 
     def delete(self):
+        # Firestore doesn't delete subcollections along with their document
+        write_in_batches(self.subcollection_deletes(self.user_uid, self.id))
         podcast_document = self.get_user_podcasts_collection(self.user_uid).document(self.id)
         return podcast_document.delete()
 
+    @classmethod
+    def subcollection_deletes(cls, user_uid, podcast_id):
+        """Deletes of every document in a podcast's entries and pending subcollections."""
+        for collection in (cls.get_entries_collection(user_uid, podcast_id),
+                           cls.get_pending_collection(user_uid, podcast_id)):
+            for document in collection.list_documents():
+                yield document, None
+
+    @timed("podcast.save")
     def save(self):
-        podcast_document = self.get_user_podcasts_collection(self.user_uid).document(self.id)
-        return podcast_document.set(self.to_dict())
+        """Write the podcast, and whichever feed entries and pending downloads changed."""
+        write_in_batches(self.writes())
+        self.mark_saved()
+
+    def writes(self):
+        """The writes needed to store the podcast and the changes to its
+        subcollections.  The podcast comes last, so it never lists pending
+        downloads whose entries haven't been written.
+
+        :return: list of (document reference, dict to set or None to delete)
+        """
+        entries_collection = self.get_entries_collection(self.user_uid, self.id)
+        pending_collection = self.get_pending_collection(self.user_uid, self.id)
+        writes = self.feed.entry_writes(entries_collection)
+        writes.extend((pending_collection.document(FeedEntry.document_id(entry_id)), None)
+                      for entry_id in self._dropped_pending)
+        writes.extend((pending_collection.document(FeedEntry.document_id(entry.id)), entry.to_dict())
+                      for entry in self._pending_entries.values())
+        writes.append((self.get_user_podcasts_collection(self.user_uid).document(self.id), self.to_dict()))
+        return writes
+
+    def mark_saved(self):
+        self.feed.mark_saved(self.get_entries_collection(self.user_uid, self.id))
+        self._pending_entries = {}
+        self._dropped_pending = set()
+
+    @property
+    def shard(self):
+        """Which of the PODCAST_SHARD_COUNT refresh shards this podcast is in."""
+        return int(hashlib.sha1(self.id.encode()).hexdigest()[:8], 16) % settings.PODCAST_SHARD_COUNT
 
     def to_dict(self):
         pojo = {"id": self.id,
                 "user_uid": self.user_uid,
+                "shard": self.shard,
                 "podcast_type": self.podcast_type,
                 "url": self.url,
                 "feed": self.feed.to_dict(),
-                "last_accessed": self.last_accessed.timestamp()}
+                "last_accessed": self.last_accessed.timestamp(),
+                "parser_state": self.parser_state,
+                "next_check_at": (self.next_check_at or datetime.datetime.utcnow()).timestamp(),
+                "unchanged_count": self.unchanged_count,
+                "failure_count": self.failure_count,
+                "pending": [pending.to_dict() for pending in self.pending]}
         return pojo
 
-    def load_feed(self):
-        all_entries = []
+    @timed("podcast.load_feed")
+    def load_feed(self, incremental=False, published_after=None, conditional=False):
+        """Parse the upstream feed.  The size and type of each entry's media is
+        reused from the stored feed where known, and probed concurrently otherwise
+        (unless the parser's links aren't the media itself, e.g. YouTube watch
+        pages; those are filled in when the entry is downloaded).
+
+        :param incremental: If True, only entries that the stored feed doesn't
+                            have yet are built (and probed).
+        :param published_after: If given, older upstream entries are skipped.
+        :param conditional: If True, raises FeedNotModified when the upstream
+                            feed hasn't changed since it was last parsed.
+        :return: Feed of the upstream entries
+        """
         podcast_type = PODCAST_TYPES[self.podcast_type]
-        parser = podcast_type.parser()
+        parser = podcast_type.parser(self.parser_state)
+        previous_state = dict(parser.state)
         # parse the link feed
-        feed = parser.parse_url(self.url)
+        try:
+            feed = parser.parse_url(self.url, conditional=conditional)
+            return self._build_feed(parser, feed, incremental, published_after)
+        except Exception:
+            # otherwise the next conditional parse would be told nothing changed,
+            # and the entries that failed here would never be built
+            parser.restore_validators(previous_state)
+            raise
+        finally:
+            self.parser_state = parser.state
+
+    def _build_feed(self, parser, feed, incremental, published_after):
+        """The Feed of a parse (see load_feed)."""
+        all_entries = []
+        raw_entries = feed["entries"]
+        if published_after is not None:
+            raw_entries = [entry for entry in raw_entries
+                           if self._parse_published(entry) > published_after]
+        # entries we already store don't need their enclosures probed again
+        known_entries = {}
+        if self.feed is not None:
+            upstream = [(entry["id"], self._parse_published(entry)) for entry in raw_entries]
+            if incremental:
+                # answered from the feed's id index, without reading any entries
+                known_ids = self.feed.stored_ids(upstream)
+                raw_entries = [entry for entry in raw_entries if entry["id"] not in known_ids]
+            else:
+                known_entries = self.feed.stored_entries(upstream)
+        unknown_links = [entry["link"] for entry in raw_entries if entry["id"] not in known_entries]
+        if parser.PROBE_ENCLOSURES:
+            link_infos = EnclosureProber().probe_all(unknown_links)
+        else:
+            link_infos = {link: UNKNOWN_ENCLOSURE for link in unknown_links}
         # for each entry, parse and append
-        for entry in feed["entries"]:
-            link_info = urllib.request.urlopen(entry["link"]).info()
-            bytes_ = link_info.get("Content-Length", 0)
-            content_type = link_info.get("Content-Type", "")
+        for entry in raw_entries:
+            known_entry = known_entries.get(entry["id"])
+            if known_entry is not None:
+                bytes_, content_type = known_entry.bytes, known_entry.mimetype
+            else:
+                bytes_, content_type = link_infos[entry["link"]]
             feed_entry = FeedEntry(id=entry["id"],
                                    title=entry["title"],
                                    description=entry["description"],
                                    link=entry["link"],
-                                   published=datetime.datetime(*(entry["published_parsed"][:6])),
+                                   published=self._parse_published(entry),
                                    bytes=bytes_,
                                    mimetype=content_type)
             all_entries.append(feed_entry)
@@ -97,21 +271,221 @@ class Podcast:
                     last_updated=datetime.datetime.utcnow(),
                     entries=all_entries)
 
+    def plan_downloads(self, entries, published_after=None):
+        """Queue new entries for download.  Entries already stored or already
+        pending are ignored, as are pending entries that have since expired.
+
+        :param entries: FeedEntry objects from the upstream feed
+        :param published_after: If given, drop pending entries published before it
+        """
+        pending_ids = {pending.entry_id for pending in self.pending}
+        entries = [entry for entry in entries if entry.id not in pending_ids]
+        stored = self.feed.stored_ids((entry.id, entry.published) for entry in entries)
+        for entry in sorted(entries, key=lambda e: e.published):
+            if entry.id not in stored and entry.id not in pending_ids:
+                self.pending.append(PendingDownload(entry.id, entry.published))
+                self._pending_entries[entry.id] = entry
+                self._dropped_pending.discard(entry.id)
+                pending_ids.add(entry.id)
+        if published_after is not None:
+            self._drop_pending([pending.entry_id for pending in self.pending
+                                if pending.published <= published_after])
+
+    def dispatch_downloads(self, limit, now=None):
+        """Pick the pending entries that should be downloaded now, keeping at most
+        `limit` downloads in flight for this podcast.  A download that was
+        dispatched more than PODCAST_DOWNLOAD_STALE_HOURS ago is assumed lost and
+        is dispatched again.
+
+        :param limit: Maximum number of concurrent downloads for this podcast
+        :param now: datetime of dispatch (defaults to now)
+        :return: list of (entry_id, task_name) to enqueue
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        stale_before = now - datetime.timedelta(hours=settings.PODCAST_DOWNLOAD_STALE_HOURS)
+        in_flight = len([pending for pending in self.pending if pending.is_in_flight(stale_before)])
+
+        dispatched = []
+        for pending in self.pending:
+            if in_flight >= limit:
+                break
+            if pending.is_in_flight(stale_before):
+                continue
+            pending.dispatched = now
+            pending.attempts += 1
+            in_flight += 1
+            dispatched.append((pending.entry_id, self.download_task_name(pending.entry_id, pending.attempts)))
+        return dispatched
+
+    def get_pending(self, entry_id):
+        """The entry of a pending download.
+
+        :param entry_id: id of the entry
+        :return: FeedEntry, or None if it isn't pending
+        """
+        if all(pending.entry_id != entry_id for pending in self.pending):
+            return None
+        if entry_id in self._pending_entries:
+            return self._pending_entries[entry_id]
+        document = self.get_pending_collection(self.user_uid, self.id) \
+                       .document(FeedEntry.document_id(entry_id)).get()
+        return FeedEntry.from_dict(document.to_dict()) if document.exists else None
+
+    def _drop_pending(self, entry_ids):
+        """Take entries off the pending queue; saving deletes their documents."""
+        entry_ids = set(entry_ids)
+        if not entry_ids:
+            return
+        self.pending = [pending for pending in self.pending if pending.entry_id not in entry_ids]
+        for entry_id in entry_ids:
+            self._pending_entries.pop(entry_id, None)
+            self._dropped_pending.add(entry_id)
+
+    def merge_download(self, entry):
+        """Move a downloaded entry from the pending queue into the feed.
+
+        :param entry: The FeedEntry, pointing at our copy of the media
+        :return: False if the entry is neither pending nor in the feed (e.g. the
+                 podcast was re-initialized during the download), so wasn't merged
+        """
+        if self.feed.contains(entry.id):
+            # merged by another attempt
+            self._drop_pending([entry.id])
+            return True
+        if all(pending.entry_id != entry.id for pending in self.pending):
+            return False
+        self._drop_pending([entry.id])
+        self.feed.insert(entry)
+        self.feed.last_updated = datetime.datetime.utcnow()
+        return True
+
+    def expire_entries(self, entries):
+        """Remove expired entries from the feed; saving it then deletes them
+        in the same write as the podcast.
+
+        :param entries: The expired FeedEntry objects
+        """
+        stored = self.feed.stored_ids((entry.id, entry.published) for entry in entries)
+        entries = [entry for entry in entries if entry.id in stored]
+        if entries:
+            self.feed.remove_all(entries)
+            self.feed.last_updated = datetime.datetime.utcnow()
+
+    def download_task_name(self, entry_id, attempt):
+        """Idempotency key for downloading an entry.  Cloud Tasks refuses a second
+        task with the same name, so each entry is only queued once per attempt."""
+        key = hashlib.sha1(f"""{self.user_uid}/{self.id}/{entry_id}""".encode()).hexdigest()
+        return f"""download-{key}-{attempt}"""
+
+    @timed("podcast.save_refresh_state")
+    def save_refresh_state(self):
+        """Persist only the parser state and refresh schedule (e.g. after an
+        unchanged or failed fetch), without rewriting the rest of the podcast."""
+        podcast_document = self.get_user_podcasts_collection(self.user_uid).document(self.id)
+        return podcast_document.update({"parser_state": self.parser_state,
+                                        "next_check_at": self.next_check_at.timestamp(),
+                                        "unchanged_count": self.unchanged_count,
+                                        "failure_count": self.failure_count})
+
+    @staticmethod
+    def _parse_published(entry):
+        return datetime.datetime(*(entry["published_parsed"][:6]))
+
     @classmethod
+    @timed("podcast.load")
     def load(cls, user_uid, podcast_id):
         document = cls.get_user_podcasts_collection(user_uid).document(podcast_id).get()
         if not document.exists:
-            raise Exception(f"""Podcast not found: {user_uid}/{podcast_id}""")
+            raise PodcastNotFound(f"""Podcast not found: {user_uid}/{podcast_id}""")
         return cls.from_document(document)
 
+    @classmethod
+    @timed("podcast.update_in_transaction")
+    def update_in_transaction(cls, user_uid, podcast_id, update):
+        """Load a podcast, apply `update` to it and write it back, all inside a
+        Firestore transaction so that concurrent tasks don't overwrite each
+        other.  `update` may be called more than once if the transaction retries.
+
+        When the changes to the subcollections don't fit in one transaction (e.g.
+        a large backfill), the transaction writes only the podcast.  Documents it
+        is about to list are written in batches before it commits, and ones it
+        stops listing are deleted after.
+
+        :param user_uid: Owner of the podcast
+        :param podcast_id: Podcast to update
+        :param update: function taking the Podcast, modifying it in place
+        :return: Whatever `update` returned
+        """
+        db = firestore.client()
+        podcast_document = cls.get_user_podcasts_collection(user_uid).document(podcast_id)
+        # deletes left until the transaction has committed
+        deferred_deletes = []
+
+        @firestore.transactional
+        def run(transaction):
+            count("firestore.transaction_attempt")
+            document = podcast_document.get(transaction=transaction)
+            if not document.exists:
+                raise PodcastNotFound(f"""Podcast not found: {user_uid}/{podcast_id}""")
+            podcast = cls.from_document(document)
+            result = update(podcast)
+            writes = podcast.writes()
+            deferred_deletes.clear()
+            if len(writes) > FIRESTORE_BATCH_LIMIT:
+                # the podcast document is always the last write
+                subcollection_writes, writes = writes[:-1], writes[-1:]
+                write_in_batches(write for write in subcollection_writes if write[1] is not None)
+                deferred_deletes.extend(write for write in subcollection_writes if write[1] is None)
+            for reference, data in writes:
+                if data is None:
+                    transaction.delete(reference)
+                else:
+                    transaction.set(reference, data)
+            return result
+
+        result = run(db.transaction())
+        write_in_batches(deferred_deletes)
+        return result
+
+    @classmethod
+    def load_access_info(cls, user_uid, podcast_id):
+        """Read only the feed's last_updated and the podcast's last_accessed times,
+        without pulling the entries.
+
+        :param user_uid: Owner of the podcast
+        :param podcast_id: Podcast to look up
+        :return: tuple of datetimes (last_updated, last_accessed)
+        """
+        document = cls.get_user_podcasts_collection(user_uid) \
+                      .document(podcast_id) \
+                      .get(field_paths=["feed.last_updated", "last_accessed"])
+        if not document.exists:
+            raise PodcastNotFound(f"""Podcast not found: {user_uid}/{podcast_id}""")
+        return (datetime.datetime.fromtimestamp(document.get("feed.last_updated")),
+                datetime.datetime.fromtimestamp(document.get("last_accessed")))
+
     @classmethod
     def from_dict(cls, dict_):
         podcast = Podcast(user_uid=dict_["user_uid"],
                           podcast_type=dict_["podcast_type"],
                           url=dict_["url"])
         podcast.id = dict_["id"]
-        podcast.feed = Feed.from_dict(dict_["feed"])
+        podcast.feed = Feed.from_dict(dict_["feed"],
+                                      entries_collection=cls.get_entries_collection(podcast.user_uid, podcast.id))
         podcast.last_accessed = datetime.datetime.fromtimestamp(dict_["last_accessed"])
+        podcast.parser_state = dict_.get("parser_state", {})
+        next_check_at = dict_.get("next_check_at")
+        podcast.next_check_at = datetime.datetime.fromtimestamp(next_check_at) if next_check_at is not None else None
+        podcast.unchanged_count = dict_.get("unchanged_count", 0)
+        podcast.failure_count = dict_.get("failure_count", 0)
+        for pending_dict in dict_.get("pending", []):
+            pending = PendingDownload.from_dict(pending_dict)
+            if "entry" in pending_dict:
+                # stored before pending entries moved to their own collection.  it is
+                # written there (and dropped from the podcast) on the next save.
+                podcast._pending_entries[pending.entry_id] = FeedEntry.from_dict(pending_dict["entry"])
+            podcast.pending.append(pending)
         return podcast
 
     @classmethod
@@ -129,51 +503,128 @@ class Podcast:
                   .document(user_uid) \
                   .collection(PODCAST_COLLECTION)
 
+    @classmethod
+    def get_entries_collection(cls, user_uid, podcast_id):
+        return cls.get_user_podcasts_collection(user_uid) \
+                  .document(podcast_id) \
+                  .collection(ENTRY_COLLECTION)
+
+    @classmethod
+    def get_pending_collection(cls, user_uid, podcast_id):
+        return cls.get_user_podcasts_collection(user_uid) \
+                  .document(podcast_id) \
+                  .collection(PENDING_COLLECTION)
+
     @classmethod
     def get_user_podcasts(cls, user_uid):
-        podcasts = []
-        collection = cls.get_user_podcasts_collection(user_uid).get()
-        for document in collection:
-            podcasts.append(cls.from_document(document.reference.get()))
-        return podcasts
+        documents = list(cls.get_user_podcasts_collection(user_uid).stream())
+        count("firestore.query")
+        return [cls.from_document(document) for document in documents]
 
     @classmethod
-    def batch_add_user_podcasts(cls, user_uid, new_podcasts):
-        db = firestore.client()
-        batch = db.batch()
+    def get_user_podcast_summaries(cls, user_uid):
+        """A user's podcasts, reading only the fields needed to list them.
 
-        user_podcasts_reference = cls.get_user_podcasts_collection(user_uid)
-        for podcast in new_podcasts:
-            user_podcasts_document = user_podcasts_reference.document(podcast.id)
-            batch.set(user_podcasts_document, podcast.to_dict())
+        :param user_uid: Owner of the podcasts
+        :return: list of PodcastSummary
+        """
+        query = cls.get_user_podcasts_collection(user_uid).select(SUMMARY_FIELDS)
+        documents = list(query.stream())
+        count("firestore.query")
+        return [PodcastSummary(id=document.get("id"),
+                               user_uid=document.get("user_uid"),
+                               podcast_type=document.get("podcast_type"),
+                               url=document.get("url"),
+                               title=document.get("feed.title"),
+                               image_url=document.get("feed.image_url"))
+                for document in documents]
 
-        batch.commit()
+    @classmethod
+    def get_shard_podcasts(cls, shard, due_before=None):
+        """All podcasts, of every user, in one refresh shard.
+
+        :param shard: 0 <= shard < PODCAST_SHARD_COUNT
+        :param due_before: If given, only podcasts whose next_check_at is not after it
+        :return: list of Podcast
+        """
+        db = firestore.client()
+        query = db.collection_group(PODCAST_COLLECTION).where("shard", "==", shard)
+        if due_before is not None:
+            query = query.where("next_check_at", "<=", due_before.timestamp())
+        return [cls.from_document(document) for document in query.stream()]
 
     @classmethod
-    def batch_remove_user_podcasts(cls, user_uid, podcasts):
+    def get_all_podcast_documents(cls):
         db = firestore.client()
-        batch = db.batch()
-        user_podcasts_documents = cls.get_user_podcasts_collection(user_uid).get()
+        return db.collection_group(PODCAST_COLLECTION).stream()
 
-        # For every existing podcast, see if it has a match in the list of podcasts.
-        for document in user_podcasts_documents:
-            podcast = cls.from_document(document)
-            if podcast in podcasts:
-                batch.delete(document.reference)
-        batch.commit()
+    @classmethod
+    def batch_add_user_podcasts(cls, user_uid, new_podcasts):
+        writes = []
+        for podcast in new_podcasts:
+            writes.extend(podcast.writes())
+        write_in_batches(writes)
+        for podcast in new_podcasts:
+            podcast.mark_saved()
+
+    @classmethod
+    def batch_remove_user_podcasts(cls, user_uid, podcasts):
+        """Delete podcasts (and their entries) by id, without reading them.
+        Deleting a podcast that doesn't exist does nothing."""
+        writes = []
+        user_podcasts_reference = cls.get_user_podcasts_collection(user_uid)
+        for podcast in podcasts:
+            # Firestore doesn't delete subcollections along with their document
+            writes.extend(cls.subcollection_deletes(user_uid, podcast.id))
+            writes.append((user_podcasts_reference.document(podcast.id), None))
+        write_in_batches(writes)
 
 
 class Feed:
+    """A podcast's feed.  Only the summary (title, image and the newest publish
+    times) is stored with the podcast, so it doesn't grow with the feed; the
+    entries live in their own subcollection and are read lazily, a page at a
+    time or by id, when they are needed.  Inserted and removed entries are
+    remembered so that a save only writes what changed.
+
+    The summary also holds a compact index of the stored entries' ids (truncated
+    hashes; expired entries leave it), so a refresh can tell which upstream
+    entries are new without reading any.
+    """
+    # publish times of this many of the newest entries are kept in the summary
+    RECENT_PUBLISHED_SIZE = 10
+    # bytes of each id hash kept in the index
+    ENTRY_HASH_SIZE = 8
+
     def __init__(self, title, description,
                  image_url, last_updated, entries=None,
-                 user_uid=None, podcast_id=None, link=None):
+                 user_uid=None, podcast_id=None, link=None,
+                 entries_collection=None, latest_published=None,
+                 recent_published=None, entry_hashes=None):
 
         self.title = title
         self.description = description
         self.image_url = image_url
         self.last_updated = last_updated
-        self.entries = entries if entries is not None else []
-        self._sort_entries()
+        self._entries_collection = entries_collection
+        self._inserted = {}
+        self._removed = set()
+
+        if entries is not None or entries_collection is None:
+            # entries given up front have never been stored
+            entries = entries if entries is not None else []
+            self._inserted = {entry.id: entry for entry in entries}
+            self._set_entries(entries)
+            self.latest_published = self.entries[0].published if self.entries else None
+            self.recent_published = [entry.published for entry in self.entries[:self.RECENT_PUBLISHED_SIZE]]
+            self._entry_hashes = {self.entry_hash(entry.id) for entry in entries}
+        else:
+            self._entries = None
+            self._index = None
+            self.latest_published = latest_published
+            self.recent_published = recent_published if recent_published is not None else []
+            # None for feeds stored before the index (see rebuild_entry_index)
+            self._entry_hashes = set(entry_hashes) if entry_hashes is not None else None
 
         if user_uid is None and podcast_id is None and link is not None:
             self.link = link
@@ -184,45 +635,330 @@ class Feed:
         else:
             raise Exception("Specify one (only one) of (user_uid, podcast_id) or (link)")
 
-    def _sort_entries(self):
-        self.entries = sorted(self.entries, key=lambda entry: entry.published, reverse=True)
+    def _set_entries(self, entries, ordered=False):
+        """Hold `entries` in memory, newest first.
+
+        :param entries: FeedEntry objects
+        :param ordered: The entries are already newest first (e.g. as stored), so needn't be sorted
+        """
+        self._entries = list(entries) if ordered else sorted(entries, key=lambda entry: entry.timestamp, reverse=True)
+        self._index = {entry.id: entry for entry in self._entries}
+        # negated publish times in the same (ascending) order, for binary searches
+        self._published_keys = array.array("d", (-entry.timestamp for entry in self._entries))
+
+    @property
+    def entries(self):
+        """All entries, newest first.  Read from Firestore on first access."""
+        if self._entries is None:
+            entries = [entry for entry in self.iter_entries() if entry.id not in self._removed]
+            # stored entries are read in order; only unsaved ones need sorting in
+            entries.extend(self._inserted.values())
+            self._set_entries(entries, ordered=not self._inserted)
+        return self._entries
+
+    def iter_entries(self, page_size=None):
+        """Iterate over the entries newest first without holding them all in
+        memory.  If they haven't been loaded, they are read from Firestore one
+        page at a time (ignoring unsaved changes).
+
+        :param page_size: Number of entries read per query
+        """
+        if self._entries is not None:
+            yield from self._entries
+            return
+
+        if page_size is None:
+            page_size = settings.FEED_ENTRY_PAGE_SIZE
+        query = self._entries_collection.order_by("published", direction=firestore.Query.DESCENDING) \
+                                        .limit(page_size)
+        last_document = None
+        while True:
+            page = query.start_after(last_document) if last_document is not None else query
+            documents = list(page.stream())
+            count("firestore.query")
+            for document in documents:
+                yield FeedEntry.from_dict(document.to_dict())
+            if len(documents) < page_size:
+                return
+            last_document = documents[-1]
+
+    def entries_published_before(self, cutoff):
+        """Entries published before `cutoff`.
+
+        :param cutoff: datetime
+        :return: list of FeedEntry, newest first
+        """
+        return self.entries_published_between(None, cutoff)
+
+    def entries_published_between(self, start, end):
+        """Entries published at or after `start` and before `end`: a binary
+        search over the loaded entries, or a range query if they haven't been
+        loaded.
+
+        :param start: datetime, or None for no lower bound
+        :param end: datetime, or None for no upper bound
+        :return: list of FeedEntry, newest first
+        """
+        if self._entries is not None:
+            # keys are negated, so the newest entries (and the upper bound) come first
+            first = bisect.bisect_right(self._published_keys, -end.timestamp()) if end is not None else 0
+            last = bisect.bisect_right(self._published_keys, -start.timestamp()) if start is not None \
+                else len(self._entries)
+            return self._entries[first:last]
+        query = self._entries_collection
+        if start is not None:
+            query = query.where("published", ">=", start.timestamp())
+        if end is not None:
+            query = query.where("published", "<", end.timestamp())
+        documents = query.order_by("published", direction=firestore.Query.DESCENDING).stream()
+        return [FeedEntry.from_dict(document.to_dict()) for document in documents
+                if document.get("id") not in self._removed]
+
+    def contains(self, entry_id):
+        if self._entry_hashes is not None:
+            return self.entry_hash(entry_id) in self._entry_hashes
+        return entry_id in self.get_many([entry_id])
+
+    def get(self, entry_id, default=None):
+        return self.get_many([entry_id]).get(entry_id, default)
+
+    def get_many(self, entry_ids):
+        """Look entries up by id: unsaved or loaded ones in memory, the rest in
+        a single batched read.
+
+        :param entry_ids: iterable of entry ids
+        :return: dict of entry id to FeedEntry, for those the feed has
+        """
+        found = {}
+        unknown_ids = []
+        for entry_id in set(entry_ids):
+            if entry_id in self._inserted:
+                found[entry_id] = self._inserted[entry_id]
+            elif entry_id in self._removed:
+                continue
+            elif self._entries is not None:
+                if entry_id in self._index:
+                    found[entry_id] = self._index[entry_id]
+            else:
+                unknown_ids.append(entry_id)
+        if unknown_ids:
+            references = [self._entries_collection.document(FeedEntry.document_id(entry_id))
+                          for entry_id in unknown_ids]
+            for document in firestore.client().get_all(references):
+                if document.exists:
+                    entry = FeedEntry.from_dict(document.to_dict())
+                    found[entry.id] = entry
+            count("firestore.get_all")
+        return found
+
+    @classmethod
+    def entry_hash(cls, entry_id):
+        return hashlib.sha1(entry_id.encode()).digest()[:cls.ENTRY_HASH_SIZE]
+
+    def stored_ids(self, entries):
+        """Which upstream entries this feed already has, from the id index.
+        Anything published after the high-water mark is new; feeds without an
+        index look the older entries up.
+
+        :param entries: iterable of (entry id, published datetime)
+        :return: set of entry ids
+        """
+        if self.latest_published is None:
+            return set()
+        entry_ids = [entry_id for entry_id, published in entries if published <= self.latest_published]
+        if self._entry_hashes is None:
+            return set(self.get_many(entry_ids))
+        return {entry_id for entry_id in entry_ids if self.entry_hash(entry_id) in self._entry_hashes}
+
+    def stored_entries(self, entries):
+        """The stored copies of the upstream entries this feed already has.
+        Only the entries it has are read.
+
+        :param entries: iterable of (entry id, published datetime)
+        :return: dict of entry id to the stored FeedEntry
+        """
+        if self._entry_hashes is None:
+            if self.latest_published is None:
+                return {}
+            return self.get_many(entry_id for entry_id, published in entries if published <= self.latest_published)
+        return self.get_many(self.stored_ids(entries))
+
+    def rebuild_entry_index(self):
+        """Hash the ids of every entry, for feeds stored before the index."""
+        self._entry_hashes = {self.entry_hash(entry.id) for entry in self.entries}
+
+    @property
+    def has_entry_index(self):
+        return self._entry_hashes is not None
+
+    def metadata_changed(self, other):
+        """Whether another (newer) feed has a different title, description or image."""
+        return (self.title, self.description, self.image_url) != \
+            (other.title, other.description, other.image_url)
+
+    def update_metadata(self, other):
+        """Copy title, description and image from another (newer) feed.  Bumps
+        last_updated if anything changed, so cached renderings are rebuilt.
+
+        :param other: Feed parsed from upstream
+        :return: True if anything changed
+        """
+        changed = self.metadata_changed(other)
+        self.title = other.title
+        self.description = other.description
+        self.image_url = other.image_url
+        if changed:
+            self.last_updated = datetime.datetime.utcnow()
+        return changed
 
     def insert(self, entry):
-        self.entries.append(entry)
-        self._sort_entries()
+        self._inserted[entry.id] = entry
+        self._removed.discard(entry.id)
+        if self._entry_hashes is not None:
+            self._entry_hashes.add(self.entry_hash(entry.id))
+        if self.latest_published is None or entry.published > self.latest_published:
+            self.latest_published = entry.published
+        self.recent_published = sorted(self.recent_published + [entry.published],
+                                       reverse=True)[:self.RECENT_PUBLISHED_SIZE]
+        if self._entries is not None:
+            self._unload_entry(entry.id)
+            # after any entries published at the same time, as a stable sort would
+            position = bisect.bisect_right(self._published_keys, -entry.timestamp)
+            self._entries.insert(position, entry)
+            self._published_keys.insert(position, -entry.timestamp)
+            self._index[entry.id] = entry
 
     def remove(self, entry):
-        self.entries = [e for e in self.entries if entry != e]
+        self._forget(entry.id)
+        if self._entries is not None:
+            self._unload_entry(entry.id)
+
+    def remove_all(self, entries):
+        """Remove many entries, rebuilding the loaded entries only once."""
+        entry_ids = {entry.id for entry in entries}
+        for entry_id in entry_ids:
+            self._forget(entry_id)
+        if self._entries is not None:
+            self._set_entries([e for e in self._entries if e.id not in entry_ids], ordered=True)
+
+    def _forget(self, entry_id):
+        self._inserted.pop(entry_id, None)
+        self._removed.add(entry_id)
+        if self._entry_hashes is not None:
+            self._entry_hashes.discard(self.entry_hash(entry_id))
+
+    def _unload_entry(self, entry_id):
+        """Drop an entry from the loaded entries, finding it by binary search."""
+        entry = self._index.pop(entry_id, None)
+        if entry is None:
+            return
+        key = -entry.timestamp
+        position = bisect.bisect_left(self._published_keys, key)
+        while self._entries[position].id != entry_id:
+            position += 1
+        del self._entries[position]
+        del self._published_keys[position]
+
+    def discard(self, entry_ids):
+        """Mark stored entries for deletion by id, without reading them."""
+        for entry_id in entry_ids:
+            if entry_id not in self._inserted:
+                self._removed.add(entry_id)
+                if self._entry_hashes is not None:
+                    self._entry_hashes.discard(self.entry_hash(entry_id))
+
+    def entry_writes(self, entries_collection):
+        """The writes needed to store the changes made since loading.
+
+        :param entries_collection: Where the entries are stored
+        :return: list of (document reference, entry dict or None to delete)
+        """
+        writes = [(entries_collection.document(FeedEntry.document_id(entry_id)), None)
+                  for entry_id in self._removed]
+        writes.extend((entries_collection.document(FeedEntry.document_id(entry.id)), entry.to_dict())
+                      for entry in self._inserted.values())
+        return writes
+
+    def mark_saved(self, entries_collection):
+        self._entries_collection = entries_collection
+        self._inserted = {}
+        self._removed = set()
 
     def to_dict(self):
-        return {"link": self.link,
+        pojo = {"link": self.link,
                 "title": self.title,
                 "description": self.description,
                 "image_url": self.image_url,
                 "last_updated": self.last_updated.timestamp(),
-                "entries": [entry.to_dict() for entry in self.entries]}
+                "latest_published": self.latest_published.timestamp()
+                if self.latest_published is not None else None,
+                "recent_published": [published.timestamp() for published in self.recent_published]}
+        if self._entry_hashes is not None:
+            pojo["entry_hashes"] = b"".join(sorted(self._entry_hashes))
+        return pojo
+
+    def to_rss(self, limit=None):
+        return "".join(self.generate_rss(limit))
 
-    def to_rss(self):
-        return render_template("podcast.rss",
-                               title=self.title,
-                               description=self.description,
-                               image=self.image_url,
-                               link=self.link,
-                               last_updated=email.utils.format_datetime(self.last_updated),
-                               entries=self.entries)
+    def generate_rss(self, limit=None):
+        """Render the feed as RSS a piece at a time.  Entries are read a page at a
+        time and each one's <item> is cached (see FeedEntry.to_rss_item), so a
+        big feed is never held in memory and only new or changed entries are
+        rendered.
+
+        :param limit: If given, only the newest `limit` entries are included
+        :return: iterable of strings
+        """
+        if limit is not None:
+            entries = itertools.islice(self.iter_entries(page_size=min(limit, settings.FEED_ENTRY_PAGE_SIZE)),
+                                       limit)
+        else:
+            entries = self.iter_entries()
+        template = current_app.jinja_env.get_template("podcast.rss")
+        stream = template.stream(title=self.title,
+                                 description=self.description,
+                                 image=self.image_url,
+                                 link=self.link,
+                                 last_updated=email.utils.format_datetime(self.last_updated),
+                                 items=(entry.to_rss_item() for entry in entries))
+        stream.enable_buffering(settings.RSS_STREAM_BUFFER)
+        return stream
 
     @classmethod
-    def from_dict(cls, feed_dict):
+    def from_dict(cls, feed_dict, entries_collection=None):
+        if "entries" in feed_dict:
+            # stored before entries moved to their own collection.  they are
+            # written there (and dropped from the podcast) on the next save.
+            entries = [FeedEntry.from_dict(e) for e in feed_dict["entries"]]
+        else:
+            entries = None
+        latest_published = feed_dict.get("latest_published")
+        entry_hashes = feed_dict.get("entry_hashes")
+        if entry_hashes is not None:
+            entry_hashes = [entry_hashes[i:i + cls.ENTRY_HASH_SIZE]
+                            for i in range(0, len(entry_hashes), cls.ENTRY_HASH_SIZE)]
         return Feed(link=feed_dict["link"],
                     title=feed_dict["title"],
                     description=feed_dict["description"],
                     image_url=feed_dict["image_url"],
                     last_updated=datetime.datetime.fromtimestamp(feed_dict["last_updated"]),
-                    entries=[FeedEntry.from_dict(e) for e in feed_dict["entries"]])
+                    entries=entries,
+                    entries_collection=entries_collection,
+                    latest_published=datetime.datetime.fromtimestamp(latest_published)
+                    if latest_published is not None else None,
+                    recent_published=[datetime.datetime.fromtimestamp(published)
+                                      for published in feed_dict.get("recent_published", [])],
+                    entry_hashes=entry_hashes)
 
 
 class FeedEntry:
-    def __init__(self, id, title, description, link, published, bytes, mimetype):
+    """One episode of a feed.  Feeds hold many of these, so they have no
+    instance dict, and entries read from Firestore keep the stored timestamp
+    until `published` is first needed as a datetime.
+    """
+    __slots__ = ("id", "title", "description", "link", "bytes", "mimetype", "path", "_published", "_timestamp")
+
+    def __init__(self, id, title, description, link, published, bytes, mimetype, path=None):
         self.id = id
         self.title = title
         self.description = description
@@ -230,6 +966,26 @@ class FeedEntry:
         self.published = published
         self.bytes = bytes
         self.mimetype = mimetype
+        # where our copy of the media is stored, relative to the bucket (once downloaded)
+        self.path = path
+
+    @property
+    def published(self):
+        if self._published is None:
+            self._published = datetime.datetime.fromtimestamp(self._timestamp)
+        return self._published
+
+    @published.setter
+    def published(self, published):
+        self._published = published
+        self._timestamp = None
+
+    @property
+    def timestamp(self):
+        """`published` as a POSIX timestamp, as stored."""
+        if self._timestamp is None:
+            self._timestamp = self._published.timestamp()
+        return self._timestamp
 
     def __eq__(self, other):
         return self.id == other.id
@@ -237,25 +993,79 @@ class FeedEntry:
     def __ne__(self, other):
         return not (self == other)
 
+    def __hash__(self):
+        return hash(self.id)
+
+    @staticmethod
+    def document_id(entry_id):
+        """Entry ids are arbitrary strings (often URLs), so documents are keyed by a hash."""
+        return hashlib.sha1(entry_id.encode()).hexdigest()
+
     @property
     def published_formatted(self):
         return email.utils.format_datetime(self.published)
 
+    def to_rss_item(self):
+        """This entry's <item>, rendered once per version of the entry."""
+        key = (self.id, self.title, self.description, self.link, self.timestamp, self.bytes, self.mimetype)
+        item = _rss_items.get(key)
+        if item is None:
+            item = Markup(current_app.jinja_env.get_template("podcast_item.rss").render(entry=self))
+            _rss_items.set(key, item)
+        return item
+
     def to_dict(self):
         return {"id": self.id,
                 "title": self.title,
                 "description": self.description,
                 "link": self.link,
-                "published": self.published.timestamp(),
+                "published": self.timestamp,
                 "bytes": self.bytes,
-                "mimetype": self.mimetype}
+                "mimetype": self.mimetype,
+                "path": self.path}
 
     @classmethod
     def from_dict(cls, feed_entry_dict):
-        return FeedEntry(id=feed_entry_dict["id"],
-                         title=feed_entry_dict["title"],
-                         description=feed_entry_dict["description"],
-                         link=feed_entry_dict["link"],
-                         published=datetime.datetime.fromtimestamp(feed_entry_dict["published"]),
-                         bytes=feed_entry_dict["bytes"],
-                         mimetype=feed_entry_dict["mimetype"])
+        entry = FeedEntry(id=feed_entry_dict["id"],
+                          title=feed_entry_dict["title"],
+                          description=feed_entry_dict["description"],
+                          link=feed_entry_dict["link"],
+                          published=None,
+                          bytes=feed_entry_dict["bytes"],
+                          mimetype=feed_entry_dict["mimetype"],
+                          path=feed_entry_dict.get("path"))
+        entry._timestamp = feed_entry_dict["published"]
+        return entry
+
+
+class PendingDownload:
+    """An entry of the upstream feed waiting to be downloaded.  Only its id and
+    publish time are kept with the podcast; the entry is in the podcast's
+    pending subcollection.
+    """
+    __slots__ = ("entry_id", "published", "dispatched", "attempts")
+
+    def __init__(self, entry_id, published, dispatched=None, attempts=0):
+        self.entry_id = entry_id
+        self.published = published
+        self.dispatched = dispatched
+        self.attempts = attempts
+
+    def is_in_flight(self, stale_before):
+        return self.dispatched is not None and self.dispatched > stale_before
+
+    def to_dict(self):
+        return {"entry_id": self.entry_id,
+                "published": self.published.timestamp(),
+                "dispatched": self.dispatched.timestamp() if self.dispatched is not None else None,
+                "attempts": self.attempts}
+
+    @classmethod
+    def from_dict(cls, pending_dict):
+        dispatched = pending_dict["dispatched"]
+        # stored before pending entries moved to their own collection
+        entry_dict = pending_dict.get("entry", pending_dict)
+        return PendingDownload(entry_id=entry_dict.get("entry_id", entry_dict.get("id")),
+                               published=datetime.datetime.fromtimestamp(entry_dict["published"]),
+                               dispatched=datetime.datetime.fromtimestamp(dispatched) if dispatched is not None else None,
+                               attempts=pending_dict["attempts"])
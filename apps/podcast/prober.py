@@ -0,0 +1,90 @@
+import collections
+import concurrent.futures
+import threading
+import urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
+
+import settings
+from apps.metrics import count
+
+
+EnclosureInfo = collections.namedtuple("EnclosureInfo", "bytes mimetype")
+UNKNOWN_ENCLOSURE = EnclosureInfo(bytes=0, mimetype="")
+
+
+class EnclosureProber:
+    """Reads the size and type of media files without downloading them.  Uses a
+    HEAD request and falls back to a one byte ranged GET for servers that don't
+    answer HEAD properly.  Many URLs are probed concurrently over pooled
+    connections, with a cap on simultaneous requests to any one host.
+    """
+    def __init__(self, max_workers=None, max_per_host=None, timeout=None):
+        self.max_workers = max_workers if max_workers is not None else settings.PROBE_MAX_WORKERS
+        self.max_per_host = max_per_host if max_per_host is not None else settings.PROBE_MAX_PER_HOST
+        self.timeout = timeout if timeout is not None else settings.PROBE_TIMEOUT
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.max_workers,
+                              pool_maxsize=self.max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._host_semaphores = collections.defaultdict(lambda: threading.BoundedSemaphore(self.max_per_host))
+        self._lock = threading.Lock()
+
+    def probe(self, url):
+        """Find the size and type of the file at `url`.
+
+        :param url: Location of file
+        :return: EnclosureInfo (UNKNOWN_ENCLOSURE if the server wouldn't say)
+        """
+        with self._host_semaphore(url):
+            try:
+                info = self._probe_head(url)
+                if info is None:
+                    info = self._probe_range(url)
+            except (requests.RequestException, ValueError):
+                # unreachable, or a malformed Content-Length / Content-Range
+                info = None
+        return info if info is not None else UNKNOWN_ENCLOSURE
+
+    def probe_all(self, urls):
+        """Probe many URLs concurrently.
+
+        :param urls: iterable of URLs
+        :return: dict of URL to EnclosureInfo
+        """
+        urls = list(set(urls))
+        if not urls:
+            return {}
+        count("http.probe", len(urls))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.max_workers, len(urls))) as executor:
+            return dict(zip(urls, executor.map(self.probe, urls)))
+
+    def _probe_head(self, url):
+        response = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+        if not response.ok or "Content-Length" not in response.headers:
+            return None
+        return EnclosureInfo(bytes=int(response.headers["Content-Length"]),
+                             mimetype=response.headers.get("Content-Type", ""))
+
+    def _probe_range(self, url):
+        with self.session.get(url, headers={"Range": "bytes=0-0"}, stream=True,
+                              allow_redirects=True, timeout=self.timeout) as response:
+            if not response.ok:
+                return None
+            mimetype = response.headers.get("Content-Type", "")
+            content_range = response.headers.get("Content-Range", "")
+            if response.status_code == 206 and "/" in content_range:
+                total = content_range.rsplit("/", 1)[1]
+                bytes_ = int(total) if total.isdigit() else 0
+            else:
+                # the server ignored the range; the body is the whole file.  it is
+                # never read, closing the response drops the connection instead.
+                bytes_ = int(response.headers.get("Content-Length", 0))
+            return EnclosureInfo(bytes=bytes_, mimetype=mimetype)
+
+    def _host_semaphore(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        with self._lock:
+            return self._host_semaphores[host]
@@ -0,0 +1,70 @@
+import datetime
+import statistics
+
+import settings
+
+
+# outcomes of a refresh
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+FAILED = "failed"
+
+
+def posting_interval(published):
+    """Typical time between episodes.
+
+    :param published: datetimes of recent episodes
+    :return: The median gap (timedelta), or None with fewer than two episodes
+    """
+    published = sorted(published)
+    if len(published) < 2:
+        return None
+    gaps = [(later - earlier).total_seconds() for earlier, later in zip(published, published[1:])]
+    return datetime.timedelta(seconds=statistics.median(gaps))
+
+
+def refresh_interval(podcast, now):
+    """How long to wait before refreshing a podcast again.  Starts from a
+    fraction of its posting interval, waits longer when nobody has polled the
+    feed lately, and backs off after unchanged or failed refreshes.
+
+    :param podcast: The Podcast, with its unchanged_count / failure_count updated
+    :param now: datetime of this refresh
+    :return: timedelta between REFRESH_MIN_INTERVAL_MINUTES and REFRESH_MAX_INTERVAL_HOURS
+    """
+    minimum = datetime.timedelta(minutes=settings.REFRESH_MIN_INTERVAL_MINUTES)
+    maximum = datetime.timedelta(hours=settings.REFRESH_MAX_INTERVAL_HOURS)
+
+    posting = posting_interval(podcast.feed.recent_published)
+    interval = posting / settings.REFRESH_CHECKS_PER_POST if posting is not None else minimum
+
+    # feeds nobody is listening to can wait
+    if podcast.last_accessed is not None and \
+            now - podcast.last_accessed > datetime.timedelta(hours=settings.REFRESH_IDLE_LISTENER_HOURS):
+        interval *= settings.REFRESH_IDLE_LISTENER_FACTOR
+
+    # back off while the feed keeps not changing, or keeps failing
+    interval *= settings.REFRESH_BACKOFF_FACTOR ** min(podcast.unchanged_count, 10)
+    if podcast.failure_count:
+        interval = max(interval, minimum * 2 ** min(podcast.failure_count, 10))
+
+    return max(minimum, min(maximum, interval))
+
+
+def schedule_refresh(podcast, outcome, now=None):
+    """Record the outcome of a refresh and set when the podcast is next due.
+
+    :param podcast: The Podcast that was refreshed
+    :param outcome: CHANGED, UNCHANGED or FAILED
+    :param now: datetime of this refresh (defaults to now)
+    :return: The new next_check_at
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+    if outcome == FAILED:
+        podcast.failure_count += 1
+    else:
+        podcast.failure_count = 0
+        podcast.unchanged_count = podcast.unchanged_count + 1 if outcome == UNCHANGED else 0
+    podcast.next_check_at = now + refresh_interval(podcast, now)
+    return podcast.next_check_at
@@ -0,0 +1,227 @@
+import datetime
+import google.cloud.storage
+import hashlib
+import os
+import requests
+from flask import url_for
+
+import settings
+from apps.metrics import count, timed
+from .media import StoredMedia
+from .utils import stream_upload, delete_blobs, ensure_staging_lifecycle, sweep_staging
+
+
+GCS_BACKEND = "gcs"
+LOCAL_BACKEND = "local"
+
+
+class StorageBackend:
+    """Where downloaded media is kept.  Paths are relative to the backend's
+    root (the bucket, or a directory), e.g. "content/<media key>".
+    """
+    # can the app serve the stored files itself (see the media_file route)?
+    SERVES_MEDIA = False
+
+    def store(self, source_url, destination_path, engine=None):
+        """Copy the file at `source_url` to `destination_path` without holding
+        it in memory, and make it public.
+
+        :param engine: Upload engine, for backends that have several (see stream_upload)
+        :return: StoredMedia
+        """
+        raise NotImplementedError
+
+    def delete(self, paths):
+        """Delete stored files.  Files that are already gone are ignored."""
+        raise NotImplementedError
+
+    def clean_staging(self, created_before):
+        """Delete the leftovers of uploads staged before `created_before`."""
+        raise NotImplementedError
+
+
+class GCSStorage(StorageBackend):
+    """Media kept in the PODCAST_STORAGE_BUCKET Cloud Storage bucket."""
+    def __init__(self, bucket_name):
+        self.bucket_name = bucket_name
+
+    @property
+    def bucket(self):
+        return google.cloud.storage.Client().get_bucket(self.bucket_name)
+
+    def store(self, source_url, destination_path, engine=None):
+        blob = stream_upload(source_url, destination_path, tmp_path=settings.PODCAST_TMP_STORAGE_DIRECTORY,
+                             bucket_name=self.bucket_name, engine=engine)
+        blob.make_public()
+        return StoredMedia(path=blob.name,
+                           public_url=blob.public_url,
+                           size=blob.size,
+                           content_type=blob.content_type)
+
+    def delete(self, paths):
+        delete_blobs(self.bucket, paths)
+
+    def clean_staging(self, created_before):
+        """Parts are staged under PODCAST_TMP_STORAGE_DIRECTORY, where a bucket
+        lifecycle rule (set up here if it's missing) deletes them.  Leftovers the
+        rule hasn't got to yet are swept one page of the listing per call."""
+        bucket = self.bucket
+        ensure_staging_lifecycle(bucket, settings.PODCAST_TMP_STORAGE_DIRECTORY,
+                                 settings.PODCAST_TMP_STORAGE_LIFETIME_DAYS)
+        sweep_staging(bucket, settings.PODCAST_TMP_STORAGE_DIRECTORY, created_before,
+                      settings.PODCAST_TMP_SWEEP_PAGE_SIZE)
+
+
+class LocalStorage(StorageBackend):
+    """Media kept in a directory on local disk and served by the app.  Files are
+    written under the staging directory (preallocated when the source gives its
+    size), synced to disk every `fsync_bytes` and moved into place when
+    complete.  The offset of the last sync is recorded next to the staged file,
+    so a retried download carries on from there.
+    """
+    SERVES_MEDIA = True
+    # media keys have no extension, so each file's content type is kept beside it
+    CONTENT_TYPE_SUFFIX = ".content-type"
+    OFFSET_SUFFIX = ".offset"
+
+    def __init__(self, root, staging_directory, chunk_size, fsync_bytes):
+        self.root = os.path.abspath(root)
+        self.staging_directory = staging_directory
+        self.chunk_size = chunk_size
+        self.fsync_bytes = fsync_bytes
+
+    def file_path(self, path):
+        """Absolute location of a stored file.  Raises ValueError for paths
+        outside the root (e.g. containing "..")."""
+        file_path = os.path.abspath(os.path.join(self.root, path))
+        if os.path.commonpath([self.root, file_path]) != self.root:
+            raise ValueError(f"""Path outside of storage: {path}""")
+        return file_path
+
+    def content_type(self, path):
+        try:
+            with open(self.file_path(path) + self.CONTENT_TYPE_SUFFIX) as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    @timed("storage.local_store", size=lambda media: media.size)
+    def store(self, source_url, destination_path, engine=None):
+        name = hashlib.sha1(destination_path.encode()).hexdigest()
+        staged_path = self.file_path(f"""{self.staging_directory}/{name}""")
+        os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+        offset = self._synced_offset(staged_path)
+
+        headers = {"Range": f"""bytes={offset}-"""} if offset else {}
+        with requests.get(source_url, stream=True, headers=headers) as response:
+            response.raise_for_status()
+            content_type = response.headers["Content-Type"]
+            if response.status_code != 206:
+                offset = 0
+            with open(staged_path, "r+b" if offset else "wb") as file:
+                file.seek(offset)
+                length = response.headers.get("Content-Length")
+                if length is not None and hasattr(os, "posix_fallocate"):
+                    # reserve the space up front, so the file isn't fragmented as it grows
+                    os.posix_fallocate(file.fileno(), offset, int(length))
+                size = self._write(file, staged_path, offset, response.iter_content(chunk_size=self.chunk_size))
+
+        final_path = self.file_path(destination_path)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        with open(final_path + self.CONTENT_TYPE_SUFFIX, "w") as file:
+            file.write(content_type)
+        os.replace(staged_path, final_path)
+        self._remove(staged_path + self.OFFSET_SUFFIX)
+        return StoredMedia(path=destination_path,
+                           public_url=url_for("media_file", path=destination_path, _external=True),
+                           size=size,
+                           content_type=content_type)
+
+    def _write(self, file, staged_path, offset, chunks):
+        """Write chunks from `offset`, syncing every fsync_bytes.
+
+        :return: The size of the file
+        """
+        unsynced = 0
+        for data in chunks:
+            file.write(data)
+            offset += len(data)
+            unsynced += len(data)
+            count("storage.write", bytes_=len(data))
+            if unsynced >= self.fsync_bytes:
+                self._sync(file, staged_path, offset)
+                unsynced = 0
+        # drop whatever was preallocated beyond the end
+        file.truncate(offset)
+        self._sync(file, staged_path, offset)
+        return offset
+
+    def _sync(self, file, staged_path, offset):
+        file.flush()
+        os.fsync(file.fileno())
+        count("storage.fsync")
+        with open(staged_path + self.OFFSET_SUFFIX, "w") as offset_file:
+            offset_file.write(str(offset))
+
+    def _synced_offset(self, staged_path):
+        """How much of a staged file an earlier attempt got safely onto disk.
+        0 if the staged file is gone or shorter than recorded."""
+        try:
+            with open(staged_path + self.OFFSET_SUFFIX) as file:
+                offset = int(file.read())
+            if os.path.getsize(staged_path) < offset:
+                return 0
+        except (FileNotFoundError, ValueError):
+            return 0
+        return offset
+
+    def delete(self, paths):
+        for path in paths:
+            file_path = self.file_path(path)
+            self._remove(file_path)
+            self._remove(file_path + self.CONTENT_TYPE_SUFFIX)
+        count("storage.delete", len(paths))
+
+    def clean_staging(self, created_before):
+        """A staged file and its offset are deleted together, once neither was
+        written since `created_before`; the offset first, so a partial clean
+        never leaves an offset pointing past the end of its file."""
+        try:
+            entries = list(os.scandir(self.file_path(self.staging_directory)))
+        except FileNotFoundError:
+            return
+        modified = {}
+        for entry in entries:
+            staged_path = entry.path[:-len(self.OFFSET_SUFFIX)] \
+                if entry.path.endswith(self.OFFSET_SUFFIX) else entry.path
+            modified[staged_path] = max(modified.get(staged_path, 0), entry.stat().st_mtime)
+        for staged_path, mtime in modified.items():
+            if datetime.datetime.utcfromtimestamp(mtime) < created_before:
+                self._remove(staged_path + self.OFFSET_SUFFIX)
+                self._remove(staged_path)
+
+    @staticmethod
+    def _remove(file_path):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+
+_storage = None
+
+
+def get_storage():
+    """The backend chosen by STORAGE_BACKEND."""
+    global _storage
+    if _storage is None:
+        if settings.STORAGE_BACKEND == GCS_BACKEND:
+            _storage = GCSStorage(settings.PODCAST_STORAGE_BUCKET)
+        elif settings.STORAGE_BACKEND == LOCAL_BACKEND:
+            _storage = LocalStorage(settings.LOCAL_STORAGE_ROOT,
+                                    staging_directory=settings.PODCAST_TMP_STORAGE_DIRECTORY,
+                                    chunk_size=settings.STREAM_UPLOAD_CHUNK_SIZE,
+                                    fsync_bytes=settings.LOCAL_STORAGE_FSYNC_BYTES)
+        else:
+            raise ValueError(f"""Unknown storage backend: {settings.STORAGE_BACKEND}""")
+    return _storage
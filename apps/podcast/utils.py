@@ -1,17 +1,40 @@
+import collections
+import concurrent.futures
+import datetime
 import google.cloud.storage
+import hashlib
+import queue
+import re
 import requests
+import threading
 import uuid
+from firebase_admin import firestore
+from google.api_core.exceptions import BadRequest, NotFound
 
 import settings
+from apps.metrics import count, current_metrics, timed, use_metrics
+
+
+UPLOAD_SESSION_COLLECTION = "upload-sessions"
+SWEEP_CURSOR_COLLECTION = "sweep-cursors"
+COMPOSE_ENGINE = "compose"
+RESUMABLE_ENGINE = "resumable"
+# most calls GCS accepts in one batch request
+STORAGE_BATCH_LIMIT = 100
 
 
 class PartitionedBlob:
     COMPOSE_LIMIT = 32
 
-    def __init__(self, bucket_name, directory="tmp", respect_compose_limit=True):
+    def __init__(self, bucket_name, directory="tmp", respect_compose_limit=True, max_workers=1, name=None):
         self.bucket_name = bucket_name
         self.directory = directory
         self.respect_compose_limit = respect_compose_limit
+        self.max_workers = max_workers
+        # with a name, temporary blobs are named predictably under directory/name, so
+        # a retried upload overwrites (or reuses, see reuse_parts) its own parts
+        self.name = name
+        self._tmp_blob_counts = collections.Counter()
 
         client = google.cloud.storage.Client()
         self.bucket = client.get_bucket(bucket_name)
@@ -19,7 +42,7 @@ class PartitionedBlob:
 
     def append_blob(self, blob):
         if len(self.blobs) >= self.COMPOSE_LIMIT:
-            self.compose(self._make_tmp_blob_name())
+            self.compose(self._make_tmp_blob_name("compose"))
         self.blobs.append(blob)
         return blob
 
@@ -33,13 +56,98 @@ class PartitionedBlob:
         blob.upload_from_filename(path, **upload_kwargs)
         return self.append_blob(blob)
 
+    def append_stream(self, chunks, max_in_flight=None, **upload_kwargs):
+        """Upload an iterable of chunks as parts, in parallel.  Chunks are read on
+        this thread and handed to `max_workers` uploader threads through a queue
+        holding at most `max_in_flight` chunks, so reading and uploading overlap
+        while memory stays bounded.  Parts are not composed as they arrive; call
+        compose() once the stream is finished.
+
+        :param chunks: iterable of bytes
+        :param max_in_flight: Maximum number of chunks read but not yet uploading
+        :return: list of the uploaded part blobs, in order
+        """
+        if max_in_flight is None:
+            max_in_flight = self.max_workers
+        parts = queue.Queue(maxsize=max_in_flight)
+        errors = []
+        metrics = current_metrics()
+
+        def upload_parts():
+            with use_metrics(metrics):
+                while True:
+                    part = parts.get()
+                    if part is None:
+                        return
+                    blob, contents = part
+                    if errors:
+                        continue  # drain the queue so the reader never blocks
+                    try:
+                        blob.upload_from_string(contents, **upload_kwargs)
+                        count("storage.upload_part", bytes_=len(contents))
+                    except Exception as e:
+                        errors.append(e)
+
+        uploaders = [threading.Thread(target=upload_parts, daemon=True) for _ in range(self.max_workers)]
+        for uploader in uploaders:
+            uploader.start()
+
+        uploaded = []
+        try:
+            for contents in chunks:
+                if errors:
+                    break
+                blob = self._make_blob()
+                uploaded.append(blob)
+                parts.put((blob, contents))
+        finally:
+            for _ in uploaders:
+                parts.put(None)
+            for uploader in uploaders:
+                uploader.join()
+
+        if errors:
+            raise errors[0]
+        self.blobs.extend(uploaded)
+        return uploaded
+
+    @timed("storage.compose_parts")
     def compose(self, path, delete_partitions=True):
-        blob = self.bucket.blob(path)
-        blob.compose(self.blobs)
+        """Compose all parts into the blob at `path`.  With more parts than
+        COMPOSE_LIMIT, groups of parts are composed in parallel into
+        intermediate blobs and then those are composed, as a tree.
+
+        :param path: Destination of the composed blob
+        :param delete_partitions: Delete the parts (and intermediates) afterwards
+        :return: The composed blob
+        """
+        blobs = self.blobs
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while len(blobs) > self.COMPOSE_LIMIT:
+                groups = [blobs[i:i + self.COMPOSE_LIMIT] for i in range(0, len(blobs), self.COMPOSE_LIMIT)]
+                intermediates = [self._make_blob(self._make_tmp_blob_name("compose")) for _ in groups]
+                list(executor.map(self._compose_group, intermediates, groups,
+                                  [delete_partitions] * len(groups)))
+                count("storage.compose", len(groups))
+                if delete_partitions:
+                    count("storage.delete", sum(len(group) for group in groups))
+                blobs = intermediates
+
+            blob = self.bucket.blob(path)
+            blob.compose(blobs)
+            count("storage.compose")
+            if delete_partitions:
+                list(executor.map(lambda _blob: _blob.delete(), blobs))
+                count("storage.delete", len(blobs))
+        self.blobs = [blob]
+        return blob
+
+    @staticmethod
+    def _compose_group(blob, group, delete_partitions):
+        blob.compose(group)
         if delete_partitions:
-            for _blob in self.blobs:
+            for _blob in group:
                 _blob.delete()
-        self.blobs = [blob]
         return blob
 
     def _make_blob(self, path=None):
@@ -48,26 +156,292 @@ class PartitionedBlob:
         blob = self.bucket.blob(path)
         return blob
 
-    def _make_tmp_blob_name(self):
-        blob_name = uuid.uuid4()
-        return f"""{self.directory}/{blob_name}"""
+    def _make_tmp_blob_name(self, kind="part"):
+        if self.name is None:
+            blob_name = uuid.uuid4()
+            return f"""{self.directory}/{blob_name}"""
+        index = self._tmp_blob_counts[kind]
+        self._tmp_blob_counts[kind] += 1
+        return f"""{self.directory}/{self.name}/{kind}-{index:06d}"""
+
+    def reuse_parts(self, part_size):
+        """Pick up the parts an earlier, failed attempt at this (named) upload
+        left behind: the leading run of parts holding `part_size` bytes each.
+        The last of them is uploaded again, so the source always has bytes left
+        to send.
+
+        :param part_size: Size of each part (i.e. the chunk size of the upload)
+        :return: The number of bytes reused, where the upload should carry on
+        """
+        if self.name is None:
+            return 0
+        parts = self.bucket.list_blobs(prefix=f"""{self.directory}/{self.name}/part-""")
+        existing = {blob.name: blob for blob in parts}
+        reused = []
+        while True:
+            blob = existing.get(self._make_tmp_blob_name())
+            if blob is None or blob.size != part_size:
+                break
+            reused.append(blob)
+        reused = reused[:-1]
+        self._tmp_blob_counts["part"] = len(reused)
+        self.blobs.extend(reused)
+        return len(reused) * part_size
+
+
+class ResumableUpload:
+    """Streams into a single object through a GCS resumable upload session.  Only
+    one chunk is held in memory, and the session URL is kept in Firestore so a
+    retried download can carry on from the last offset GCS committed.
+    """
+    # every chunk but the last must be a multiple of this many bytes
+    CHUNK_ALIGNMENT = 256 * 1024
+    # GCS keeps sessions for a week; don't try to resume one close to that
+    SESSION_LIFETIME = datetime.timedelta(days=6)
+
+    def __init__(self, blob, chunk_size):
+        self.blob = blob
+        self.chunk_size = max(self.CHUNK_ALIGNMENT, chunk_size - chunk_size % self.CHUNK_ALIGNMENT)
+        self.session = requests.Session()
+        self.session_url = None
+        self.offset = 0
+
+    def upload(self, source_url):
+        """Copy the file at `source_url` into the blob, resuming an earlier
+        attempt at the same destination if there is one.
+
+        :param source_url: Location of file
+        :return: The finished blob
+        """
+        self.session_url = self._load_session()
+        if self.session_url is not None:
+            self.offset = self._committed_offset()
+            if self.offset is None:  # the earlier attempt had finished
+                self._delete_session()
+                self.blob.reload()
+                return self.blob
+
+        headers = {"Range": f"""bytes={self.offset}-"""} if self.offset else {}
+        with requests.get(source_url, stream=True, headers=headers) as response:
+            response.raise_for_status()
+            content_type = response.headers["Content-Type"]
+            if self.session_url is None:
+                self.session_url = self.blob.create_resumable_upload_session(content_type=content_type)
+                self._save_session()
+            stream = response.iter_content(chunk_size=self.CHUNK_ALIGNMENT)
+            if self.offset and response.status_code != 206:
+                stream = _skip(stream, self.offset)
+            self._upload_stream(stream)
+
+        self._delete_session()
+        self.blob.reload()
+        return self.blob
+
+    def _upload_stream(self, stream):
+        buffer = bytearray()
+        for data in stream:
+            buffer.extend(data)
+            while len(buffer) >= self.chunk_size:
+                committed = self._put(buffer[:self.chunk_size], final=False)
+                del buffer[:committed]
+        # send the remainder (possibly empty) and the total size
+        while True:
+            committed = self._put(buffer, final=True)
+            if committed is None:
+                return
+            del buffer[:committed]
+
+    def _put(self, data, final):
+        """Send one chunk.
 
+        :return: How many bytes of `data` GCS kept (None once the upload is done)
+        """
+        total = str(self.offset + len(data)) if final else "*"
+        if data:
+            content_range = f"""bytes {self.offset}-{self.offset + len(data) - 1}/{total}"""
+        else:
+            content_range = f"""bytes */{total}"""
+        response = self.session.put(self.session_url, data=bytes(data),
+                                    headers={"Content-Range": content_range})
+        count("storage.upload_chunk", bytes_=len(data))
+        if response.status_code in (200, 201):
+            self.offset += len(data)
+            return None
+        if response.status_code != 308:
+            response.raise_for_status()
+        committed = self._parse_range(response) - self.offset
+        self.offset += committed
+        return committed
 
+    def _committed_offset(self):
+        """Ask GCS how much of the session was stored (None if it's complete)."""
+        response = self.session.put(self.session_url, headers={"Content-Range": "bytes */*"})
+        if response.status_code in (200, 201):
+            return None
+        if response.status_code != 308:
+            # the session is gone; start over
+            self.session_url = None
+            return 0
+        return self._parse_range(response)
+
+    @staticmethod
+    def _parse_range(response):
+        match = re.match(r"bytes=0-(\d+)", response.headers.get("Range", ""))
+        return int(match.group(1)) + 1 if match is not None else 0
+
+    def _session_document(self):
+        key = hashlib.sha1(f"""{self.blob.bucket.name}/{self.blob.name}""".encode()).hexdigest()
+        return firestore.client().collection(UPLOAD_SESSION_COLLECTION).document(key)
+
+    def _load_session(self):
+        document = self._session_document().get()
+        if not document.exists:
+            return None
+        session = document.to_dict()
+        if datetime.datetime.fromtimestamp(session["created"]) + self.SESSION_LIFETIME < \
+                datetime.datetime.utcnow():
+            return None
+        return session["session_url"]
+
+    def _save_session(self):
+        self._session_document().set({"session_url": self.session_url,
+                                      "created": datetime.datetime.utcnow().timestamp()})
+
+    def _delete_session(self):
+        self._session_document().delete()
+
+
+@timed("storage.stream_upload", size=lambda blob: blob.size)
 def stream_upload(source_url, destination_path, tmp_path="tmp", bucket_name=None,
-                  chunk_size=None):
+                  chunk_size=None, workers=None, max_in_flight=None, engine=None):
+    """Copy the file at `source_url` into the bucket without holding it in memory.
+
+    :param engine: COMPOSE_ENGINE uploads chunks as temporary parts in parallel and
+                   composes them.  RESUMABLE_ENGINE streams into one resumable upload
+                   session, which makes far fewer GCS operations and can pick up
+                   where a failed attempt stopped.  Defaults to STREAM_UPLOAD_ENGINE.
+    :return: The uploaded blob
+    """
     if bucket_name is None:
         bucket_name = settings.PODCAST_STORAGE_BUCKET
 
     if chunk_size is None:
         chunk_size = settings.STREAM_UPLOAD_CHUNK_SIZE
 
-    pblob = PartitionedBlob(bucket_name=bucket_name, directory=tmp_path, respect_compose_limit=True)
-    request = requests.get(source_url, stream=True)
+    if engine is None:
+        engine = settings.STREAM_UPLOAD_ENGINE
+
+    if engine == RESUMABLE_ENGINE:
+        client = google.cloud.storage.Client()
+        blob = client.get_bucket(bucket_name).blob(destination_path)
+        return ResumableUpload(blob, chunk_size).upload(source_url)
+    elif engine != COMPOSE_ENGINE:
+        raise ValueError(f"""Unknown upload engine: {engine}""")
+
+    if workers is None:
+        workers = settings.STREAM_UPLOAD_WORKERS
+
+    if max_in_flight is None:
+        max_in_flight = settings.STREAM_UPLOAD_MAX_IN_FLIGHT
+
+    # parts are named after the destination, so a retry can reuse what the last attempt uploaded
+    upload_name = hashlib.sha1(f"""{bucket_name}/{destination_path}""".encode()).hexdigest()
+    pblob = PartitionedBlob(bucket_name=bucket_name, directory=tmp_path,
+                            respect_compose_limit=True, max_workers=workers, name=upload_name)
+    offset = pblob.reuse_parts(chunk_size)
+    headers = {"Range": f"""bytes={offset}-"""} if offset else {}
+    request = requests.get(source_url, stream=True, headers=headers)
+    request.raise_for_status()
     content_type = request.headers["Content-Type"]
     stream = request.iter_content(chunk_size=chunk_size)
-    for chunk in stream:
-        pblob.append_contents(chunk)
+    if offset and request.status_code != 206:
+        stream = _skip(stream, offset)
+    pblob.append_stream(stream, max_in_flight=max_in_flight)
     blob = pblob.compose(destination_path, delete_partitions=True)
     blob.content_type = content_type
     blob.update()
     return blob
+
+
+def _skip(stream, skip_bytes):
+    """The source ignored our Range header; drop the bytes we already have."""
+    for data in stream:
+        if skip_bytes >= len(data):
+            skip_bytes -= len(data)
+            continue
+        yield data[skip_bytes:]
+        skip_bytes = 0
+
+
+def delete_blobs(bucket, paths):
+    """Delete many blobs using batch requests.  Blobs that are already gone are
+    ignored.
+
+    :param bucket: Bucket holding the blobs
+    :param paths: Bucket-relative paths of the blobs
+    """
+    paths = list(paths)
+    for i in range(0, len(paths), STORAGE_BATCH_LIMIT):
+        chunk = paths[i:i + STORAGE_BATCH_LIMIT]
+        try:
+            with bucket.client.batch():
+                for path in chunk:
+                    bucket.delete_blob(path)
+        except NotFound:
+            # a batch only reports its first failure; delete the rest one by one
+            bucket.delete_blobs(chunk, on_error=lambda blob: None)
+        count("storage.batch")
+        count("storage.delete", len(chunk))
+
+
+def ensure_staging_lifecycle(bucket, directory, age):
+    """Make sure the bucket has a lifecycle rule deleting the objects under
+    `directory` `age` DAYS after they were created.  The bucket's metadata
+    (read with it) is only updated if the rule is missing or different.
+
+    :param bucket: Bucket (as returned by get_bucket)
+    :param directory: The staging prefix, e.g. PODCAST_TMP_STORAGE_DIRECTORY
+    :param age: DAYS until staged objects are deleted
+    :return: True if the bucket was updated
+    """
+    prefix = [f"""{directory}/"""]
+    rule = {"action": {"type": "Delete"}, "condition": {"age": age, "matchesPrefix": prefix}}
+    rules = [dict(existing) for existing in bucket.lifecycle_rules]
+    if rule in rules:
+        return False
+    rules = [existing for existing in rules if existing.get("condition", {}).get("matchesPrefix") != prefix]
+    bucket.lifecycle_rules = rules + [rule]
+    bucket.patch()
+    count("storage.metadata")
+    return True
+
+
+def sweep_staging(bucket, directory, created_before, page_size):
+    """Delete leftover temporary blobs created before `created_before`.  Lists
+    one page per call; the listing cursor is kept in Firestore, so each call
+    carries on where the last one stopped and starts over at the end.
+
+    :param bucket: Bucket holding the blobs
+    :param directory: The staging prefix
+    :param created_before: datetime (UTC)
+    :param page_size: Number of blobs listed per call
+    :return: The number of blobs deleted
+    """
+    key = hashlib.sha1(f"""{bucket.name}/{directory}""".encode()).hexdigest()
+    cursor_document = firestore.client().collection(SWEEP_CURSOR_COLLECTION).document(key)
+    cursor = cursor_document.get()
+    page_token = cursor.get("page_token") if cursor.exists else None
+
+    blobs = bucket.list_blobs(prefix=f"""{directory}/""", max_results=page_size, page_token=page_token)
+    try:
+        page = list(next(blobs.pages, []))
+    except BadRequest:
+        # the cursor has expired; start over
+        blobs = bucket.list_blobs(prefix=f"""{directory}/""", max_results=page_size)
+        page = list(next(blobs.pages, []))
+    count("storage.list")
+
+    old_paths = [blob.name for blob in page if blob.time_created.replace(tzinfo=None) < created_before]
+    delete_blobs(bucket, old_paths)
+    cursor_document.set({"page_token": blobs.next_page_token})
+    return len(old_paths)
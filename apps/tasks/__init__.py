@@ -1,3 +1,3 @@
 
 from .utils import require_cron_job, require_task_api_key
-from .utils import add_task, get_task_arguments
+from .utils import add_task, add_tasks, get_task_arguments
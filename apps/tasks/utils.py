@@ -1,10 +1,22 @@
+import concurrent.futures
+import threading
+import time
 from flask import abort
 from flask import request
 from functools import wraps
+from google.api_core.exceptions import AlreadyExists, DeadlineExceeded, InternalServerError, ServiceUnavailable
 from google.cloud import tasks_v2
-from urllib.parse import parse_qs
+from urllib.parse import parse_qs, urlencode
 
 import settings
+from apps.metrics import current_metrics, timed, use_metrics
+
+
+# errors worth retrying a task submission for
+TRANSIENT_ERRORS = (DeadlineExceeded, InternalServerError, ServiceUnavailable)
+
+_client = None
+_client_lock = threading.Lock()
 
 
 def get_task_arguments():
@@ -61,23 +73,76 @@ def require_task_api_key(function):
     return decorated_function
 
 
-def add_task(relative_uri, form_data=None):
+def get_tasks_client():
+    """The process-wide Cloud Tasks client.  Creating one opens a new gRPC
+    channel and authenticates, so it is only done once; the client is
+    thread-safe and shared by every task submission.
+
+    :return: tasks_v2.CloudTasksClient
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = tasks_v2.CloudTasksClient()
+        return _client
+
+
+@timed("tasks.add_task")
+def add_task(relative_uri, form_data=None, name=None):
     """Submits a task for execution.  Includes a task API key by default
     for security.  This key must be checked for by the task being run!
 
     :param relative_uri: Task URI
     :param form_data: Data to be passed to task
-    :return: Task response object
+    :param name: Optional task name, used as an idempotency key.  If a task
+                 with this name was already created, nothing is added.
+    :return: Task response object (None if the named task already existed)
     """
-    if form_data is None:
-        form_data = {}
-    form_data["TASK_API_KEY"] = settings.TASK_API_KEY
-    post_data = "&".join(["{}={}".format(key, value) for key, value in form_data.items()])
-    client = tasks_v2.CloudTasksClient()
-
+    client = get_tasks_client()
     parent = client.queue_path(settings.PROJECT,
                                settings.PODCAST_PARSING_QUEUE_LOCATION,
                                settings.PODCAST_PARSING_QUEUE_NAME)
+    task = _make_task(client, relative_uri, form_data, name)
+
+    for attempt in range(settings.TASK_ENQUEUE_RETRIES + 1):
+        try:
+            return client.create_task(parent, task)
+        except AlreadyExists:
+            return None
+        except TRANSIENT_ERRORS:
+            if attempt == settings.TASK_ENQUEUE_RETRIES:
+                raise
+            time.sleep(0.1 * 2 ** attempt)
+
+
+def add_tasks(tasks, max_workers=None):
+    """Submits many tasks concurrently over the shared client.  Each task is
+    retried on its own if Cloud Tasks reports a transient error.
+
+    :param tasks: iterable of (relative_uri, form_data) or (relative_uri, form_data, name)
+    :param max_workers: Maximum number of submissions in flight
+    :return: list of task response objects, in the order given
+    """
+    tasks = list(tasks)
+    if not tasks:
+        return []
+    if max_workers is None:
+        max_workers = settings.TASK_ENQUEUE_CONCURRENCY
+    metrics = current_metrics()
+
+    def submit(task):
+        with use_metrics(metrics):
+            return add_task(*task)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(tasks))) as executor:
+        return list(executor.map(submit, tasks))
+
+
+def _make_task(client, relative_uri, form_data, name):
+    if form_data is None:
+        form_data = {}
+    form_data = dict(form_data, TASK_API_KEY=settings.TASK_API_KEY)
+    post_data = urlencode(form_data)
 
     # Construct the request body.
     task = {
@@ -87,5 +152,9 @@ def add_task(relative_uri, form_data=None):
             'body': post_data.encode()
         }
     }
-    response = client.create_task(parent, task)
-    return response
+    if name is not None:
+        task["name"] = client.task_path(settings.PROJECT,
+                                        settings.PODCAST_PARSING_QUEUE_LOCATION,
+                                        settings.PODCAST_PARSING_QUEUE_NAME,
+                                        name)
+    return task
@@ -0,0 +1,43 @@
+"""Benchmarks for Recaster's hot paths, run against in-memory fakes of the Google
+services and a local HTTP server.  See README.md, or run:
+
+    python -m benchmarks --help
+
+The app's settings are read from settings.py if there is one, otherwise from
+settings.py.example; the benchmarks fill in the values they need.
+"""
+import importlib.machinery
+import importlib.util
+import os.path
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# values the benchmarks need, used where settings leave them empty
+BENCHMARK_SETTINGS = {
+    "PROJECT": "benchmark",
+    "SECRET_KEY": "benchmark",
+    "PODCAST_PARSING_QUEUE_NAME": "benchmark",
+    "PODCAST_PARSING_QUEUE_LOCATION": "benchmark",
+    "PODCAST_STORAGE_BUCKET": "benchmark",
+    "TASK_API_KEY": "benchmark",
+}
+
+
+def load_settings():
+    """Import `settings`, falling back to settings.py.example."""
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    try:
+        import settings
+    except ImportError:
+        loader = importlib.machinery.SourceFileLoader("settings", os.path.join(ROOT, "settings.py.example"))
+        settings = importlib.util.module_from_spec(importlib.util.spec_from_loader("settings", loader))
+        loader.exec_module(settings)
+        sys.modules["settings"] = settings
+
+    for name, value in BENCHMARK_SETTINGS.items():
+        if not getattr(settings, name, None):
+            setattr(settings, name, value)
+    return settings
@@ -0,0 +1,293 @@
+"""Run the benchmarks and print throughput, latency percentiles and operation
+counts for each benchmark and size.
+
+    python -m benchmarks                         # everything, default sizes
+    python -m benchmarks --only load_feed,to_rss --sizes 10,1000
+    python -m benchmarks --json results.json     # keep results ...
+    python -m benchmarks --baseline results.json # ... and fail on regressions against them
+"""
+import argparse
+import collections
+import datetime
+import json
+import logging
+import math
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree
+
+from . import load_settings
+
+settings = load_settings()
+
+from . import fakes  # noqa: E402
+fakes.install()
+
+import main  # noqa: E402
+# instrument_task logs a JSON line per task on stdout, which would mix into the results
+logging.getLogger("apps.metrics").setLevel(logging.WARNING)
+from apps.podcast import Podcast  # noqa: E402
+from apps.podcast.podcast import Feed, FeedEntry, _rss_items  # noqa: E402
+from apps.podcast.storage import LocalStorage  # noqa: E402
+from apps.podcast.utils import stream_upload, COMPOSE_ENGINE, RESUMABLE_ENGINE  # noqa: E402
+from .server import BenchmarkServer  # noqa: E402
+
+
+USER_UID = "benchmark-user"
+SIZES = [10, 100, 1000, 10000]
+# every episode of the feed is downloaded, so the whole chain is run on smaller feeds by default
+CHAIN_SIZES = [10, 100, 1000]
+UPLOAD_SIZES = [1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024]
+
+Result = collections.namedtuple("Result", "name size unit samples operations")
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of a list of samples."""
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def measure(name, size, unit, run, setup=None, verify=None, repeat=5):
+    """Time `run(setup())` `repeat` times.  Operations made by setup aren't counted.
+    `verify`, if given, is called with the same state after each run to check
+    the run did its work; it isn't timed or counted.
+
+    :param size: Units processed per run (entries or bytes), for throughput
+    :param unit: Name of the units
+    :return: Result with the duration of each run and the mean operations per run
+    """
+    samples = []
+    totals = collections.Counter()
+    for _ in range(repeat):
+        state = setup() if setup is not None else None
+        fakes.operations.reset()
+        start = time.perf_counter()
+        run(state)
+        samples.append(time.perf_counter() - start)
+        totals.update(fakes.operations.snapshot())
+        if verify is not None:
+            verify(state)
+    return Result(name, size, unit, samples, {operation: count / repeat for operation, count in totals.items()})
+
+
+def create_podcast(url):
+    fakes.reset()
+    podcast = Podcast(user_uid=USER_UID, podcast_type="rss", url=url)
+    podcast.initialize()
+    podcast.save()
+    return podcast
+
+
+def bench_load_feed(server, size, media_size, repeat):
+    """Parsing a feed for the first time (every enclosure is probed) and again
+    incrementally once all of its entries are stored."""
+    url = server.feed_url(size, media_size)
+    yield measure("load_feed", size, "entries",
+                  lambda podcast: podcast.load_feed(),
+                  setup=lambda: create_podcast(url), repeat=repeat)
+
+    def stored_podcast():
+        podcast = create_podcast(url)
+        for entry in podcast.load_feed().entries:
+            podcast.feed.insert(entry)
+        podcast.save()
+        return Podcast.load(podcast.user_uid, podcast.id)
+
+    yield measure("load_feed_incremental", size, "entries",
+                  lambda podcast: podcast.load_feed(incremental=True),
+                  setup=stored_podcast, repeat=repeat)
+
+
+def bench_stream_upload(server, size, repeat):
+    """Copying one media file into storage with each upload engine, and onto
+    local disk."""
+    for engine in [COMPOSE_ENGINE, RESUMABLE_ENGINE]:
+        yield measure(f"""stream_upload_{engine}""", size, "bytes",
+                      lambda _: stream_upload(server.media_url(size), "content/benchmark",
+                                              tmp_path=settings.PODCAST_TMP_STORAGE_DIRECTORY,
+                                              engine=engine),
+                      setup=fakes.reset, repeat=repeat)
+
+    with tempfile.TemporaryDirectory() as root:
+        storage = LocalStorage(root, staging_directory=settings.PODCAST_TMP_STORAGE_DIRECTORY,
+                               chunk_size=settings.STREAM_UPLOAD_CHUNK_SIZE,
+                               fsync_bytes=settings.LOCAL_STORAGE_FSYNC_BYTES)
+        yield measure("stream_upload_local", size, "bytes",
+                      lambda _: storage.store(server.media_url(size), "content/benchmark"), repeat=repeat)
+
+
+def bench_to_rss(size, repeat):
+    """Rendering a feed of `size` entries that are already in memory, the
+    first time (no <item> cached) and again."""
+    def feed():
+        now = datetime.datetime.utcnow()
+        return Feed(title="Benchmark podcast",
+                    description="Synthetic feed for benchmarks",
+                    image_url="http://localhost/cover.jpg",
+                    last_updated=now,
+                    link="http://localhost/",
+                    entries=[FeedEntry(id=f"""urn:benchmark:episode:{i}""",
+                                       title=f"""Episode {i} & <friends>""",
+                                       description=f"""<p>Description of episode {i} &amp; more</p>""",
+                                       link=f"""http://localhost/media/episode-{i}.mp3?a=1&b=2""",
+                                       published=now - datetime.timedelta(hours=i),
+                                       bytes=1024,
+                                       mimetype="audio/mpeg")
+                             for i in range(size)])
+
+    def cold_feed():
+        _rss_items.clear()
+        return feed()
+
+    def well_formed(feed):
+        # titles, links and descriptions hold "&" and "<", which must come out escaped
+        items = xml.etree.ElementTree.fromstring(feed.to_rss()).findall("channel/item")
+        expected = feed.entries[0]
+        if len(items) != size or (items[0].findtext("title"), items[0].findtext("link"),
+                                  items[0].findtext("description")) != \
+                (expected.title, expected.link, expected.description):
+            raise RuntimeError("Rendered feed doesn't round-trip its entries")
+
+    rendered = feed()
+    rendered.to_rss()
+    yield measure("to_rss", size, "entries", lambda feed: feed.to_rss(), setup=cold_feed,
+                  verify=well_formed, repeat=repeat)
+    yield measure("to_rss_warm", size, "entries", lambda feed: feed.to_rss(), setup=lambda: rendered,
+                  verify=well_formed, repeat=repeat)
+
+
+def run_tasks(client, timings):
+    """Run queued Cloud Tasks one at a time (including the tasks they queue)
+    until the queue is empty, timing each by endpoint."""
+    while True:
+        task = fakes.TASKS.pop()
+        if task is None:
+            return
+        request = task["app_engine_http_request"]
+        start = time.perf_counter()
+        response = client.post(request["relative_uri"], data=request["body"],
+                               content_type="application/octet-stream")
+        timings[request["relative_uri"]].append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError(f"""Task {request["relative_uri"]} failed with {response.status}""")
+
+
+def bench_task_chain(server, size, media_size, repeat):
+    """The whole refresh of a new podcast: cron -> queue-shard ->
+    download-podcast -> a download-episode per entry, then the first poll of
+    the feed.  Also reports the latency of each task."""
+    client = main.app.test_client()
+    url = server.feed_url(size, media_size)
+    timings = collections.defaultdict(list)
+
+    def refresh(podcast):
+        client.get("/internal/start-parsing/", headers={"X-Cloudscheduler": "true"})
+        run_tasks(client, timings)
+        response = client.get(f"""/podcast/{podcast.user_uid}/{podcast.id}/""")
+        if response.status_code != 200:
+            raise RuntimeError(f"""Feed poll failed with {response.status}""")
+
+    def downloaded_all(podcast):
+        # a chain that downloads nothing would otherwise be timed as a fast one
+        stored = len(Podcast.load(podcast.user_uid, podcast.id).feed.entries)
+        if stored != size:
+            raise RuntimeError(f"""Task chain stored {stored} of {size} entries""")
+
+    yield measure("task_chain", size, "entries", refresh, setup=lambda: create_podcast(url),
+                  verify=downloaded_all, repeat=repeat)
+    for uri, samples in sorted(timings.items()):
+        yield Result(f"""task_chain_{size}:{uri}""", 1, "tasks", samples, {})
+
+
+def format_result(result):
+    p50, p95, p99 = (percentile(result.samples, p) for p in (50, 95, 99))
+    throughput = result.size / p50 if p50 else float("inf")
+    operations = " ".join(f"""{name}={count:g}""" for name, count in sorted(result.operations.items()))
+    return (f"""{result.name:<45} {result.size:>10} {len(result.samples):>5}  """
+            f"""{p50 * 1000:>10.2f} {p95 * 1000:>10.2f} {p99 * 1000:>10.2f}  """
+            f"""{throughput:>12.1f} {result.unit + "/s":<10} {operations}""")
+
+
+def compare(results, baseline, tolerance):
+    """Find results slower (by median) than `tolerance` or using more operations than the baseline.
+
+    :return: list of descriptions of the regressions
+    """
+    previous = {(r["name"], r["size"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result.name, result.size))
+        if before is None:
+            continue
+        p50, before_p50 = percentile(result.samples, 50), percentile(before["samples"], 50)
+        if p50 > before_p50 * (1 + tolerance):
+            regressions.append(f"""{result.name} ({result.size}): median {before_p50 * 1000:.2f}ms """
+                               f"""-> {p50 * 1000:.2f}ms""")
+        for operation, count in result.operations.items():
+            if count > before["operations"].get(operation, 0):
+                regressions.append(f"""{result.name} ({result.size}): {operation} """
+                                   f"""{before["operations"].get(operation, 0):g} -> {count:g}""")
+    return regressions
+
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(",")]
+
+
+def run_benchmarks(arguments=None):
+    benchmarks = ["load_feed", "stream_upload", "to_rss", "task_chain"]
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", type=lambda value: value.split(","), default=benchmarks,
+                        help=f"""comma separated benchmarks to run ({", ".join(benchmarks)})""")
+    parser.add_argument("--sizes", type=parse_sizes, default=SIZES, help="feed sizes (entries)")
+    parser.add_argument("--chain-sizes", type=parse_sizes, default=CHAIN_SIZES,
+                        help="feed sizes (entries) for task_chain")
+    parser.add_argument("--upload-sizes", type=parse_sizes, default=UPLOAD_SIZES,
+                        help="file sizes (bytes) for stream_upload")
+    parser.add_argument("--media-size", type=int, default=64 * 1024,
+                        help="size (bytes) of each episode in the synthetic feeds")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each benchmark and size")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results (from --json) to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown of the median allowed against the baseline (default 0.2 = 20%%)")
+    options = parser.parse_args(arguments)
+
+    results = []
+    print(f"""{"benchmark":<45} {"size":>10} {"runs":>5}  {"p50 ms":>10} {"p95 ms":>10} {"p99 ms":>10}  """
+          f"""{"throughput":>12} {"":<10} operations/run""")
+    with BenchmarkServer() as server, main.app.test_request_context("/"):
+        runs = []
+        if "load_feed" in options.only:
+            runs.extend(bench_load_feed(server, size, options.media_size, options.repeat)
+                        for size in options.sizes)
+        if "stream_upload" in options.only:
+            runs.extend(bench_stream_upload(server, size, options.repeat) for size in options.upload_sizes)
+        if "to_rss" in options.only:
+            runs.extend(bench_to_rss(size, options.repeat) for size in options.sizes)
+        if "task_chain" in options.only:
+            runs.extend(bench_task_chain(server, size, options.media_size, options.repeat)
+                        for size in options.chain_sizes)
+        for run in runs:
+            for result in run:
+                print(format_result(result), flush=True)
+                results.append(result)
+
+    if options.json:
+        with open(options.json, "w") as file:
+            json.dump([result._asdict() for result in results], file, indent=2)
+
+    if options.baseline:
+        with open(options.baseline) as file:
+            regressions = compare(results, json.load(file), options.tolerance)
+        for regression in regressions:
+            print(f"""REGRESSION {regression}""", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run_benchmarks())
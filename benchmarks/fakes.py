@@ -0,0 +1,682 @@
+"""In-memory stand-ins for the Google services Recaster talks to: the Firestore
+client, Firebase Auth user lookups, the Cloud Storage client / bucket / blob API
+and the Cloud Tasks client.  They implement the subset of each API the app uses, and count every
+operation in `operations` so benchmarks can report RPCs next to timings.
+
+Call install() before importing main or apps; it patches the client
+constructors, so the application code runs unchanged.
+"""
+import collections
+import contextlib
+import copy
+import datetime
+import functools
+import itertools
+import re
+import threading
+import uuid
+import firebase_admin
+import firebase_admin.auth
+import google.cloud.storage
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists, BadRequest, InvalidArgument, NotFound
+from google.cloud import tasks_v2
+
+
+class OperationCounter:
+    """Thread-safe tally of operations made against the fakes."""
+    def __init__(self):
+        self._counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def count(self, operation, amount=1):
+        with self._lock:
+            self._counts[operation] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+operations = OperationCounter()
+
+
+# Firestore
+
+
+def _get_field(data, field_path):
+    for name in field_path.split("."):
+        data = data[name]
+    return data
+
+
+def _set_field(data, field_path, value):
+    names = field_path.split(".")
+    for name in names[:-1]:
+        data = data.setdefault(name, {})
+    current = data.get(names[-1])
+    if isinstance(value, firestore.ArrayUnion):
+        current = list(current) if isinstance(current, list) else []
+        value = current + [v for v in value.values if v not in current]
+    data[names[-1]] = copy.deepcopy(value)
+
+
+def _merge(data, changes):
+    for name, value in changes.items():
+        if isinstance(value, dict) and isinstance(data.get(name), dict):
+            _merge(data[name], value)
+        else:
+            _set_field(data, name, value)
+
+
+class FakeFirestore:
+    """A Firestore database held in a dict of document path to data."""
+    def __init__(self):
+        self.documents = {}
+        self.lock = threading.RLock()
+
+    def client(self, app=None):
+        return FakeFirestoreClient(self)
+
+    def reset(self):
+        with self.lock:
+            self.documents.clear()
+
+
+class FakeFirestoreClient:
+    def __init__(self, database):
+        self._database = database
+
+    def collection(self, collection_id):
+        return FakeCollectionReference(self._database, (collection_id,))
+
+    def collection_group(self, collection_id):
+        return FakeQuery(self._database, group=collection_id)
+
+    def document(self, path):
+        return FakeDocumentReference(self._database, tuple(path.split("/")))
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        references = list(references)
+        operations.count("firestore.read", len(references))
+        return [reference._snapshot(field_paths) for reference in references]
+
+    def batch(self):
+        return FakeWriteBatch(self._database)
+
+    def transaction(self):
+        return FakeTransaction(self._database)
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        return copy.deepcopy(_get_field(self._data, field_path))
+
+
+class FakeDocumentReference:
+    def __init__(self, database, path):
+        self._database = database
+        self._path = path
+
+    @property
+    def id(self):
+        return self._path[-1]
+
+    @property
+    def path(self):
+        return "/".join(self._path)
+
+    @property
+    def parent(self):
+        return FakeCollectionReference(self._database, self._path[:-1])
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocumentReference) and self._path == other._path
+
+    def __hash__(self):
+        return hash(self._path)
+
+    def collection(self, collection_id):
+        return FakeCollectionReference(self._database, self._path + (collection_id,))
+
+    def get(self, field_paths=None, transaction=None):
+        operations.count("firestore.read")
+        return self._snapshot(field_paths)
+
+    def set(self, document_data, merge=False):
+        operations.count("firestore.write")
+        self._set(document_data, merge)
+
+    def update(self, field_updates):
+        operations.count("firestore.write")
+        self._update(field_updates)
+
+    def delete(self):
+        operations.count("firestore.write")
+        self._delete()
+
+    def _snapshot(self, field_paths=None):
+        with self._database.lock:
+            data = self._database.documents.get(self._path)
+            if data is not None and field_paths is not None:
+                projected = {}
+                for field_path in field_paths:
+                    try:
+                        _set_field(projected, field_path, _get_field(data, field_path))
+                    except (KeyError, TypeError):
+                        continue
+                data = projected
+            return FakeDocumentSnapshot(self, copy.deepcopy(data))
+
+    def _set(self, document_data, merge=False):
+        with self._database.lock:
+            data = self._database.documents.get(self._path) if merge else None
+            data = copy.deepcopy(data) if data is not None else {}
+            if merge:
+                _merge(data, document_data)
+            else:
+                for name, value in document_data.items():
+                    _set_field(data, name, value)
+            self._database.documents[self._path] = data
+
+    def _update(self, field_updates):
+        with self._database.lock:
+            if self._path not in self._database.documents:
+                raise NotFound(f"""No document to update: {self.path}""")
+            for field_path, value in field_updates.items():
+                _set_field(self._database.documents[self._path], field_path, value)
+
+    def _delete(self):
+        with self._database.lock:
+            self._database.documents.pop(self._path, None)
+
+
+class FakeQuery:
+    def __init__(self, database, parent=None, group=None, filters=(), orders=(), limit=None, cursor=None,
+                 field_paths=None):
+        self._database = database
+        self._parent = parent
+        self._group = group
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._cursor = cursor
+        self._field_paths = field_paths
+
+    def _copy(self, **changes):
+        arguments = dict(parent=self._parent, group=self._group, filters=self._filters,
+                         orders=self._orders, limit=self._limit, cursor=self._cursor,
+                         field_paths=self._field_paths)
+        arguments.update(changes)
+        return FakeQuery(self._database, **arguments)
+
+    def select(self, field_paths):
+        return self._copy(field_paths=list(field_paths))
+
+    def where(self, field_path, op_string, value):
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields):
+        return self._copy(cursor=document_fields)
+
+    def get(self, transaction=None):
+        return self.stream(transaction)
+
+    def stream(self, transaction=None):
+        operations.count("firestore.query")
+        with self._database.lock:
+            matches = [(path, data) for path, data in self._database.documents.items()
+                       if self._in_scope(path) and all(self._matches(data, f) for f in self._filters)]
+        # filtered fields are implicitly ordered first, then by document path
+        orders = self._orders or tuple((field_path, "ASCENDING") for field_path, op, _ in self._filters
+                                       if op in ("<", "<=", ">", ">="))
+        key = functools.cmp_to_key(lambda a, b: self._compare(a, b, orders))
+        matches.sort(key=key)
+        if self._cursor is not None:
+            cursor = (self._cursor.reference._path, self._cursor._data)
+            matches = [match for match in matches if self._compare(match, cursor, orders) > 0]
+        if self._limit is not None:
+            matches = matches[:self._limit]
+        operations.count("firestore.read", max(1, len(matches)))
+        return iter([FakeDocumentReference(self._database, path)._snapshot(self._field_paths)
+                     for path, _ in matches])
+
+    def _in_scope(self, path):
+        if self._group is not None:
+            return len(path) % 2 == 0 and path[-2] == self._group
+        return path[:-1] == self._parent
+
+    @staticmethod
+    def _matches(data, field_filter):
+        field_path, op, value = field_filter
+        try:
+            field = _get_field(data, field_path)
+        except (KeyError, TypeError):
+            return False
+        if op == "array_contains":
+            return isinstance(field, list) and value in field
+        if op == "in":
+            return field in value
+        try:
+            return {"==": field == value, "<": field < value, "<=": field <= value,
+                    ">": field > value, ">=": field >= value}[op]
+        except TypeError:
+            return False
+
+    @staticmethod
+    def _compare(a, b, orders):
+        (a_path, a_data), (b_path, b_data) = a, b
+        for field_path, direction in orders:
+            a_value, b_value = _get_field(a_data, field_path), _get_field(b_data, field_path)
+            if a_value != b_value:
+                result = -1 if a_value < b_value else 1
+                return -result if direction == firestore.Query.DESCENDING else result
+        return (a_path > b_path) - (a_path < b_path)
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, database, path):
+        super().__init__(database, parent=path)
+        self._path = path
+
+    @property
+    def id(self):
+        return self._path[-1]
+
+    def document(self, document_id=None):
+        if document_id is None:
+            document_id = uuid.uuid4().hex
+        return FakeDocumentReference(self._database, self._path + (document_id,))
+
+    def list_documents(self, page_size=None):
+        operations.count("firestore.query")
+        with self._database.lock:
+            paths = [path for path in self._database.documents if path[:-1] == self._path]
+        return [FakeDocumentReference(self._database, path) for path in paths]
+
+
+class FakeWriteBatch:
+    def __init__(self, database):
+        self._database = database
+        self._writes = []
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(("set", reference, document_data, merge))
+
+    def update(self, reference, field_updates):
+        self._writes.append(("update", reference, field_updates, False))
+
+    def delete(self, reference):
+        self._writes.append(("delete", reference, None, False))
+
+    # Firestore rejects batches and transactions with more writes than this
+    MAX_WRITES = 500
+
+    def commit(self):
+        if len(self._writes) > self.MAX_WRITES:
+            raise InvalidArgument(f"""Too many writes in one commit: {len(self._writes)}""")
+        operations.count("firestore.commit")
+        operations.count("firestore.write", len(self._writes))
+        with self._database.lock:
+            # batches are atomic; fail before changing anything
+            existing = set()
+            for kind, reference, _, _ in self._writes:
+                if kind == "update" and reference._path not in existing and \
+                        reference._path not in self._database.documents:
+                    raise NotFound(f"""No document to update: {reference.path}""")
+                if kind == "set":
+                    existing.add(reference._path)
+            for kind, reference, data, merge in self._writes:
+                if kind == "set":
+                    reference._set(data, merge)
+                elif kind == "update":
+                    reference._update(data)
+                else:
+                    reference._delete()
+        self._writes = []
+
+
+class FakeTransaction(FakeWriteBatch):
+    """Writes are applied at commit.  Benchmarks drive tasks one at a time, so
+    there's never contention and a transaction never retries."""
+    pass
+
+
+def transactional(function):
+    """Replacement for firestore.transactional that works with FakeTransaction."""
+    @functools.wraps(function)
+    def run(transaction, *args, **kwargs):
+        result = function(transaction, *args, **kwargs)
+        transaction.commit()
+        return result
+    return run
+
+
+# Cloud Storage
+
+
+class FakeStorage:
+    """Every bucket's objects, plus open resumable upload sessions.  Sessions
+    are served by the benchmark HTTP server (see server.py) at `upload_url`.
+    """
+    def __init__(self):
+        self.buckets = collections.defaultdict(dict)
+        self.lifecycle_rules = collections.defaultdict(list)
+        self.sessions = {}
+        self.upload_url = None
+        self.lock = threading.RLock()
+
+    def reset(self):
+        with self.lock:
+            self.buckets.clear()
+            self.lifecycle_rules.clear()
+            self.sessions.clear()
+
+    def resumable_put(self, session_id, content_range, data):
+        """Handle one PUT to a resumable upload session, as GCS would.
+
+        :return: tuple of (HTTP status, headers)
+        """
+        operations.count("storage.upload_chunk")
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return 404, {}
+            blob, buffer = session
+            match = re.match(r"bytes (?:(\d+)-\d+|\*)/(\d+|\*)", content_range or "")
+            if match is None:
+                return 400, {}
+            if match.group(1) is not None:
+                start = int(match.group(1))
+                if start > len(buffer):
+                    return 400, {}
+                buffer.extend(data[len(buffer) - start:])
+            if match.group(2) != "*" and int(match.group(2)) == len(buffer):
+                del self.sessions[session_id]
+                blob._store(bytes(buffer), blob.content_type)
+                return 200, {}
+        return 308, ({"Range": f"""bytes=0-{len(buffer) - 1}"""} if buffer else {})
+
+
+class FakeStorageClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_bucket(self, bucket_name):
+        operations.count("storage.metadata")
+        return FakeBucket(bucket_name)
+
+    def bucket(self, bucket_name):
+        return FakeBucket(bucket_name)
+
+    @contextlib.contextmanager
+    def batch(self):
+        operations.count("storage.batch")
+        yield self
+
+    def list_blobs(self, bucket_or_name, prefix=None, max_results=None, page_token=None):
+        bucket = bucket_or_name if isinstance(bucket_or_name, FakeBucket) else FakeBucket(bucket_or_name)
+        return bucket.list_blobs(prefix=prefix, max_results=max_results, page_token=page_token)
+
+
+class FakeBlobIterator:
+    """One listing of blobs, as pages of at most `max_results`."""
+    def __init__(self, blobs, max_results):
+        self._blobs = blobs
+        self._max_results = max_results
+        self.next_page_token = None
+
+    def __iter__(self):
+        return iter(self._blobs)
+
+    @property
+    def pages(self):
+        page = self._blobs
+        if self._max_results is not None and len(page) > self._max_results:
+            page = page[:self._max_results]
+            self.next_page_token = page[-1].name
+        yield iter(page)
+
+
+class FakeBucket:
+    def __init__(self, name):
+        self.name = name
+        self.lifecycle_rules = list(STORAGE.lifecycle_rules[name])
+
+    def patch(self):
+        operations.count("storage.metadata")
+        STORAGE.lifecycle_rules[self.name] = list(self.lifecycle_rules)
+
+    @property
+    def _objects(self):
+        return STORAGE.buckets[self.name]
+
+    @property
+    def client(self):
+        return FakeStorageClient()
+
+    def blob(self, blob_name):
+        return FakeBlob(self, blob_name)
+
+    def get_blob(self, blob_name):
+        operations.count("storage.metadata")
+        blob = FakeBlob(self, blob_name)
+        return blob if blob._object is not None else None
+
+    def delete_blob(self, blob_name):
+        FakeBlob(self, blob_name).delete()
+
+    def delete_blobs(self, blobs, on_error=None):
+        for blob in blobs:
+            try:
+                self.delete_blob(blob if isinstance(blob, str) else blob.name)
+            except NotFound:
+                if on_error is None:
+                    raise
+                on_error(blob)
+
+    def list_blobs(self, prefix=None, max_results=None, page_token=None):
+        operations.count("storage.list")
+        with STORAGE.lock:
+            names = sorted(name for name in self._objects if prefix is None or name.startswith(prefix))
+        if page_token is not None:
+            names = [name for name in names if name > page_token]
+        return FakeBlobIterator([FakeBlob(self, name) for name in names], max_results)
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.content_type = None
+        self.size = None
+        self.time_created = None
+        self._load()
+
+    @property
+    def _object(self):
+        return self.bucket._objects.get(self.name)
+
+    @property
+    def public_url(self):
+        return f"""https://storage.googleapis.com/{self.bucket.name}/{self.name}"""
+
+    def _load(self):
+        stored = self._object
+        if stored is not None:
+            self.size = len(stored["data"])
+            self.content_type = stored["content_type"]
+            self.time_created = stored["time_created"]
+
+    def _store(self, data, content_type):
+        with STORAGE.lock:
+            self.bucket._objects[self.name] = {
+                "data": data,
+                "content_type": content_type,
+                "time_created": datetime.datetime.now(datetime.timezone.utc)}
+        self._load()
+
+    def exists(self):
+        operations.count("storage.metadata")
+        return self._object is not None
+
+    def reload(self):
+        operations.count("storage.metadata")
+        if self._object is None:
+            raise NotFound(f"""No such object: {self.bucket.name}/{self.name}""")
+        self._load()
+
+    def update(self):
+        operations.count("storage.metadata")
+        with STORAGE.lock:
+            if self._object is None:
+                raise NotFound(f"""No such object: {self.bucket.name}/{self.name}""")
+            self._object["content_type"] = self.content_type
+
+    def make_public(self):
+        operations.count("storage.metadata")
+
+    def upload_from_string(self, data, content_type=None):
+        operations.count("storage.upload")
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._store(bytes(data), content_type or self.content_type)
+
+    def upload_from_file(self, file_obj, content_type=None):
+        self.upload_from_string(file_obj.read(), content_type)
+
+    def upload_from_filename(self, filename, content_type=None):
+        with open(filename, "rb") as file_obj:
+            self.upload_from_file(file_obj, content_type)
+
+    def download_as_string(self):
+        operations.count("storage.download")
+        if self._object is None:
+            raise NotFound(f"""No such object: {self.bucket.name}/{self.name}""")
+        return self._object["data"]
+
+    def compose(self, sources):
+        operations.count("storage.compose")
+        if len(sources) > 32:
+            raise BadRequest("A maximum of 32 components can be composed")
+        with STORAGE.lock:
+            parts = []
+            for source in sources:
+                if source._object is None:
+                    raise NotFound(f"""No such object: {source.bucket.name}/{source.name}""")
+                parts.append(source._object["data"])
+            self._store(b"".join(parts), self.content_type)
+
+    def delete(self):
+        operations.count("storage.delete")
+        with STORAGE.lock:
+            if self.bucket._objects.pop(self.name, None) is None:
+                raise NotFound(f"""No such object: {self.bucket.name}/{self.name}""")
+
+    def create_resumable_upload_session(self, content_type=None, size=None):
+        operations.count("storage.session")
+        session_id = uuid.uuid4().hex
+        self.content_type = content_type
+        with STORAGE.lock:
+            STORAGE.sessions[session_id] = (self, bytearray())
+        return f"""{STORAGE.upload_url}/{session_id}"""
+
+
+# Cloud Tasks
+
+
+class FakeTasksClient:
+    """Collects created tasks in TASKS instead of sending them to a queue."""
+    _task_ids = itertools.count()
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @staticmethod
+    def queue_path(project, location, queue):
+        return f"""projects/{project}/locations/{location}/queues/{queue}"""
+
+    def task_path(self, project, location, queue, task):
+        return f"""{self.queue_path(project, location, queue)}/tasks/{task}"""
+
+    def create_task(self, parent, task):
+        operations.count("tasks.create")
+        task = dict(task)
+        with TASKS.lock:
+            if "name" in task:
+                if task["name"] in TASKS.names:
+                    raise AlreadyExists(f"""Task already exists: {task["name"]}""")
+                TASKS.names.add(task["name"])
+            else:
+                task["name"] = f"""{parent}/tasks/{next(self._task_ids)}"""
+            TASKS.queue.append(task)
+        return task
+
+
+class FakeTaskQueue:
+    def __init__(self):
+        self.queue = collections.deque()
+        self.names = set()
+        self.lock = threading.Lock()
+
+    def pop(self):
+        with self.lock:
+            return self.queue.popleft() if self.queue else None
+
+    def reset(self):
+        with self.lock:
+            self.queue.clear()
+            self.names.clear()
+
+
+# Firebase Auth
+
+
+FakeUser = collections.namedtuple("FakeUser", "uid disabled")
+
+
+def get_user(user_uid):
+    operations.count("auth.get_user")
+    return FakeUser(uid=user_uid, disabled=False)
+
+
+FIRESTORE = FakeFirestore()
+STORAGE = FakeStorage()
+TASKS = FakeTaskQueue()
+
+
+def install():
+    """Point firebase_admin (Firestore and Auth), google.cloud.storage and tasks_v2 at the fakes."""
+    firebase_admin.initialize_app = lambda *args, **kwargs: None
+    firestore.client = FIRESTORE.client
+    firestore.transactional = transactional
+    firebase_admin.auth.get_user = get_user
+    google.cloud.storage.Client = FakeStorageClient
+    tasks_v2.CloudTasksClient = FakeTasksClient
+
+
+def reset():
+    """Empty every fake service and the operation counts."""
+    FIRESTORE.reset()
+    STORAGE.reset()
+    TASKS.reset()
+    operations.reset()
@@ -0,0 +1,172 @@
+"""A local HTTP server standing in for upstream podcast hosts and for GCS's
+resumable upload endpoint.
+
+    /feed/<entries>.xml?media_size=<bytes>   synthetic RSS feed (honours If-None-Match)
+    /media/<name>?size=<bytes>               media file (honours HEAD and Range)
+    /upload/<session>                        resumable upload sessions (see fakes.FakeStorage)
+"""
+import datetime
+import email.utils
+import hashlib
+import http.server
+import re
+import threading
+import urllib.parse
+from xml.sax.saxutils import escape
+
+from .fakes import operations, STORAGE
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def synthetic_feed(entries, base_url, media_size, now=None):
+    """An RSS feed of `entries` episodes, newest first and an hour apart.
+
+    :return: The feed (bytes)
+    """
+    if now is None:
+        now = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    items = []
+    for i in range(entries):
+        published = email.utils.format_datetime(
+            (now - datetime.timedelta(hours=i)).replace(tzinfo=datetime.timezone.utc))
+        link = f"""{base_url}/media/episode-{i}.mp3?size={media_size}"""
+        items.append(f"""
+        <item>
+            <title>Episode {i}</title>
+            <link>{escape(link)}</link>
+            <description>Description of episode {i}</description>
+            <guid>urn:benchmark:episode:{i}</guid>
+            <pubDate>{published}</pubDate>
+            <enclosure url="{escape(link)}" length="{media_size}" type="audio/mpeg"/>
+        </item>""")
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0">
+    <channel>
+        <title>Benchmark podcast ({entries} episodes)</title>
+        <link>{base_url}/</link>
+        <description>Synthetic feed for benchmarks</description>
+        <image>
+            <url>{base_url}/media/cover.jpg?size=1024</url>
+            <title>Benchmark podcast</title>
+            <link>{base_url}/</link>
+        </image>{"".join(items)}
+    </channel>
+</rss>
+""".encode("utf-8")
+
+
+class BenchmarkRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # rendered feeds, by (base_url, entries, media_size); refreshes see the same document
+    _feeds = {}
+    _feeds_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._handle(send_body=False)
+
+    def do_GET(self):
+        self._handle(send_body=True)
+
+    def do_PUT(self):
+        operations.count("http.PUT")
+        match = re.match(r"/upload/(\w+)$", self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        data = self.rfile.read(length) if length else b""
+        if match is None:
+            return self._send_status(404)
+        status, headers = STORAGE.resumable_put(match.group(1), self.headers.get("Content-Range"), data)
+        self._send_status(status, headers)
+
+    def _handle(self, send_body):
+        operations.count(f"""http.{self.command}""")
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        feed_match = re.match(r"/feed/(\d+)\.xml$", url.path)
+        if feed_match is not None:
+            media_size = int(query.get("media_size", ["1024"])[0])
+            return self._send_feed(int(feed_match.group(1)), media_size, send_body)
+        if url.path.startswith("/media/"):
+            return self._send_media(int(query.get("size", ["1024"])[0]), send_body)
+        self._send_status(404)
+
+    def _send_feed(self, entries, media_size, send_body):
+        # keyed by server too, as each one links media to its own address
+        base_url = f"""http://{self.server.server_address[0]}:{self.server.server_address[1]}"""
+        key = (base_url, entries, media_size)
+        with self._feeds_lock:
+            if key not in self._feeds:
+                self._feeds[key] = synthetic_feed(entries, base_url, media_size)
+            body = self._feeds[key]
+        etag = f'''"{hashlib.sha1(body).hexdigest()}"'''
+        if self.headers.get("If-None-Match") == etag:
+            return self._send_status(304, {"ETag": etag})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/rss+xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def _send_media(self, size, send_body):
+        start, end = 0, size - 1
+        range_match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if range_match is not None:
+            start = int(range_match.group(1))
+            end = min(int(range_match.group(2)), end) if range_match.group(2) else end
+            self.send_response(206)
+            self.send_header("Content-Range", f"""bytes {start}-{end}/{size}""")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if not send_body:
+            return
+        chunk = bytes(range(256)) * (CHUNK_SIZE // 256)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = chunk[:min(remaining, CHUNK_SIZE)]
+            self.wfile.write(data)
+            remaining -= len(data)
+
+    def _send_status(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class BenchmarkServer:
+    """Runs BenchmarkRequestHandler on a free local port in a background thread."""
+    def __init__(self):
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), BenchmarkRequestHandler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"""http://{host}:{port}"""
+
+    def feed_url(self, entries, media_size):
+        return f"""{self.url}/feed/{entries}.xml?media_size={media_size}"""
+
+    def media_url(self, size):
+        return f"""{self.url}/media/benchmark.bin?size={size}"""
+
+    def __enter__(self):
+        self._thread.start()
+        STORAGE.upload_url = f"""{self.url}/upload"""
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
@@ -1,25 +1,35 @@
+import concurrent.futures
 import datetime
 import firebase_admin.auth
-import google.cloud.storage
 import os.path
 import urllib.parse
 import settings
 from firebase_admin import firestore
 from flask import abort
 from flask import Flask
+from flask import jsonify
 from flask import render_template
 from flask import redirect
 from flask import request
 from flask import Response
+from flask import send_file
+from flask import stream_with_context
 from flask import url_for
-from apps.auth.utils import is_authenticated, get_authenticated_user
+from werkzeug.http import is_resource_modified
+from apps.auth.utils import is_authenticated, get_authenticated_user, get_user
 from apps.auth.utils import session_login, session_logout
 from apps.auth.utils import require_authenticated
-from apps.podcast import Podcast, PodcastParserException
+from apps.metrics import instrument_task, registry
+from apps.podcast import Podcast, PodcastParserException, PodcastNotFound, FeedNotModified
+from apps.podcast.access import access_tracker
 from apps.podcast.downloader import DownloadException
+from apps.podcast.media import MediaIndex
+from apps.podcast.schedule import schedule_refresh, CHANGED, UNCHANGED, FAILED
+from apps.podcast.storage import get_storage
+from apps.podcast.feed_cache import feed_etag, get_rendered_feed, invalidate_rendered_feed
 from apps.podcast.type import PODCAST_TYPES
 from apps.tasks import require_cron_job, require_task_api_key
-from apps.tasks import add_task, get_task_arguments
+from apps.tasks import add_task, add_tasks, get_task_arguments
 
 
 OK_RESPONSE = "Ok"
@@ -65,18 +75,36 @@ def logout():
 
 @app.route('/podcast/<user_uid>/<podcast_id>/')
 def podcast(user_uid, podcast_id):
-    """Render RSS for specified podcast
+    """Render RSS for specified podcast.  Only the feed's last_updated time is
+    read on each poll; the RSS itself is streamed, rendered once per feed
+    update, and clients that already have it get a 304.  last_accessed is only
+    written (in batches) once it has moved by more than the tracking granularity.
+    An optional `limit` query parameter renders only the newest entries.
 
     :param podcast_id: Podcast to render
     :return: RSS feed
     """
+    limit = request.args.get("limit", type=int)
+    if limit is not None and limit < 1:
+        abort(400)
     try:
-        podcast = Podcast.load(user_uid, podcast_id)
-        podcast.last_accessed = datetime.datetime.utcnow()
-        podcast.save()
+        last_updated, last_accessed = Podcast.load_access_info(user_uid, podcast_id)
     except Exception:
         abort(404)
-    return Response(podcast.feed.to_rss(), mimetype="text/xml")
+    access_tracker.record(user_uid, podcast_id, last_accessed)
+
+    etag = feed_etag(user_uid, podcast_id, last_updated, limit)
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_updated):
+        rss = get_rendered_feed(user_uid, podcast_id, last_updated, limit)
+        response = Response(stream_with_context(rss), mimetype="text/xml")
+    else:
+        response = Response(status=304)
+    response.set_etag(etag)
+    response.last_modified = last_updated
+    response.cache_control.public = True
+    response.cache_control.max_age = settings.RSS_CACHE_MAX_AGE
+    response.cache_control.must_revalidate = True
+    return response
 
 
 @app.route('/podcasts/')
@@ -87,7 +115,7 @@ def podcasts_list():
     :return: the template of all podcasts for this user. rendered to view.
     """
     user = get_authenticated_user()
-    podcasts = Podcast.get_user_podcasts(user.uid)
+    podcasts = Podcast.get_user_podcast_summaries(user.uid)
 
     return render_template("podcasts.html", podcasts=podcasts, podcast_types=PODCAST_TYPES)
 
@@ -129,11 +157,12 @@ def podcast_edit(user_uid, podcast_id):
             try:
                 podcast.url = url
                 podcast.podcast_type = podcast_type
-                podcast.initialize()
+                stale_entries = podcast.initialize()
             except PodcastParserException as e:
                 parser_error = True
             else:
                 podcast.save()
+                release_entries_media(podcast, stale_entries)
                 return redirect(url_for("podcasts_list"))
     return render_template("podcast_edit.html",
                            podcast=podcast,
@@ -153,103 +182,159 @@ def podcast_delete(user_uid):
     if user.uid != user_uid:
         raise Exception("Illegal access.")
     podcast_id = request.form["podcast_id"]
-    Podcast.load(user.uid, podcast_id).delete()
+    podcast = Podcast.load(user.uid, podcast_id)
+    release_entries_media(podcast, podcast.feed.iter_entries())
+    podcast.delete()
+    invalidate_rendered_feed(user.uid, podcast_id)
     return redirect(url_for("podcasts_list"))
 
 
 @app.route('/internal/start-parsing/', methods=["GET", "POST"])
 @require_cron_job
+@instrument_task
 def task_start_parsing():
     """Cron job starts parsing.  Calls tasks as these can (depending on
     configuration) run for longer than ordinary crons and web calls.
 
     :return: Ok
     """
-    add_task(url_for("task_queue_users"))
+    add_tasks((url_for("task_queue_shard"), {"shard": shard})
+              for shard in range(settings.PODCAST_SHARD_COUNT))
     add_task(url_for("task_clean_tmp_files"))
     return OK_RESPONSE
 
 
-@app.route('/internal/queue-users/', methods=["GET", "POST"])
-@require_task_api_key
-def task_queue_users():
-    """Second step in parsing.  Gets all users and makes a task
-    for each one to parse their updated podcasts.
-
-    :return: Ok
-    """
-    users = firebase_admin.auth.list_users().iterate_all()
-    for user in users:
-        if user.disabled:  # skip disabled users
-            continue
-        # add user task
-        add_task(url_for("task_queue_podcasts"), {"user_uid": user.uid})
-
-    return OK_RESPONSE
-
-
 @app.route('/internal/clean-temporary-files', methods=["GET", "POST"])
 @require_task_api_key
+@instrument_task
 def task_clean_tmp_files():
-    """Parallel to parsing, we delete all the old files that were part of PartitionedBlob
+    """Parallel to parsing, clean up what failed uploads left under
+    PODCAST_TMP_STORAGE_DIRECTORY (see StorageBackend.clean_staging).
 
-    TODO: move the pieces into the staging.* bucket and set a rule for cleanup instead
+    :return: Ok
     """
-    client = google.cloud.storage.Client()
-    blobs = client.list_blobs(settings.PODCAST_STORAGE_BUCKET,
-                              prefix=settings.PODCAST_TMP_STORAGE_DIRECTORY)
-    for blob in blobs:
-        if blob.time_created.replace(tzinfo=None) + datetime.timedelta(1) <= datetime.datetime.now():
-            blob.delete()
-
+    created_before = datetime.datetime.utcnow() - \
+        datetime.timedelta(settings.PODCAST_TMP_STORAGE_LIFETIME_DAYS)
+    get_storage().clean_staging(created_before)
     return OK_RESPONSE
 
 
-@app.route('/internal/queue-podcasts/', methods=["GET", "POST"])
+@app.route('/internal/queue-shard/', methods=["GET", "POST"])
 @require_task_api_key
-def task_queue_podcasts():
-    """Third step in parsing.  Massively parallelize by making a separate
-    task for each podcast when parsing.
+@instrument_task
+def task_queue_shard():
+    """Second step in parsing.  Podcasts are split into PODCAST_SHARD_COUNT
+    shards by a hash of their id; this finds the podcasts of one shard that
+    are due for a refresh with a single collection-group query (users without
+    podcasts cost nothing), expires old episodes (see expire_entries) and makes
+    a separate task for each podcast.  Podcasts of disabled users are skipped.
+
+    next_check_at is set when a podcast's refresh task runs, a little after the
+    cron run that queued it, so podcasts due within half a cron period are
+    refreshed now rather than a whole period late.
 
     :return: Ok
     """
     data = get_task_arguments()
-    user_uid = data["user_uid"]
-
-    client = google.cloud.storage.Client()
-    bucket = client.get_bucket(settings.PODCAST_STORAGE_BUCKET)
-    podcasts = Podcast.get_user_podcasts(user_uid)
+    shard = int(data["shard"])
+
+    due_before = datetime.datetime.utcnow() + datetime.timedelta(minutes=settings.REFRESH_CRON_PERIOD_MINUTES) / 2
+    podcasts = Podcast.get_shard_podcasts(shard, due_before=due_before)
+    # each owner is looked up once; users that no longer exist count as disabled
+    users = {user_uid: get_user(user_uid) for user_uid in {podcast.user_uid for podcast in podcasts}}
+    podcasts = [podcast for podcast in podcasts
+                if users[podcast.user_uid] is not None and not users[podcast.user_uid].disabled]
+    download_tasks = []
+    expiration_cutoff = datetime.datetime.utcnow() - datetime.timedelta(settings.EPISODE_EXPIRATION_DAYS)
     for podcast in podcasts:
-        old_entries = [entry for entry in podcast.feed.entries
-                       if entry.published + datetime.timedelta(settings.EPISODE_EXPIRATION_DAYS) <
-                       datetime.datetime.utcnow()]
-
-        for old_entry in old_entries:
-            link = old_entry.link
-            path = urllib.parse.urlparse(link).path
-            bucket_relative_path = os.path.sep.join(path.split(os.path.sep)[2:])
-            blob = bucket.blob(bucket_relative_path)
-            blob.delete()
-            podcast.feed.remove(old_entry)
-            podcast.save()
-
         # determine if the podcast has been used in recent enough time
         if podcast.last_accessed + datetime.timedelta(settings.PODCAST_EXPIRATION_DAYS) < \
                 datetime.datetime.utcnow():
+            release_entries_media(podcast, podcast.feed.iter_entries())
             podcast.delete()
         else:
-            add_task(url_for("task_recursive_download_podcast"),
-                     {"user_uid": user_uid, "podcast_id": podcast.id})
+            expire_entries(podcast, expiration_cutoff)
+            download_tasks.append((url_for("task_download_podcast"),
+                                   {"user_uid": podcast.user_uid, "podcast_id": podcast.id}))
+    add_tasks(download_tasks)
     return OK_RESPONSE
 
 
+def expire_entries(podcast, cutoff):
+    """Remove the entries of a podcast published before `cutoff` in a single
+    transactional write, then release their media.
+
+    :param podcast: Podcast to expire entries of
+    :param cutoff: datetime
+    """
+    old_entries = podcast.feed.entries_published_before(cutoff)
+    if not old_entries:
+        return
+    # applied to a freshly read copy, in case a download finished meanwhile
+    Podcast.update_in_transaction(podcast.user_uid, podcast.id,
+                                  lambda stored_podcast: stored_podcast.expire_entries(old_entries))
+    release_entries_media(podcast, old_entries)
+
+
+def release_entries_media(podcast, entries):
+    """Drop entries' claims on their downloaded media, then delete the files
+    no other feed entry shares (in batch requests, on Cloud Storage).
+
+    :param podcast: Podcast the entries belong to
+    :param entries: The FeedEntry objects being removed
+    """
+    def release(entry):
+        path = entry.path
+        if path is None:
+            # stored before entries kept their path; it's in our public URL
+            path = "/".join(urllib.parse.urlparse(entry.link).path.split("/")[2:])
+        # files are named by their media key (see Downloader.create_destination_path)
+        media_key = os.path.basename(path)
+        if MediaIndex.release(media_key, MediaIndex.reference(podcast.user_uid, podcast.id, entry.id)):
+            return path
+        return None
+
+    entries = list(entries)
+    if not entries:
+        return
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(settings.MEDIA_RELEASE_CONCURRENCY, len(entries))) as executor:
+        paths = [path for path in executor.map(release, entries) if path is not None]
+    get_storage().delete(paths)
+
+
+@app.route('/media/<path:path>')
+def media_file(path):
+    """Serve a downloaded episode when media is kept on local disk (see
+    STORAGE_BACKEND).  Range requests are honoured, and the file is passed to
+    the server's file wrapper (sendfile, where it has it) rather than read
+    into Python.
+
+    :param path: Path of the file within storage
+    :return: The file
+    """
+    storage = get_storage()
+    if not storage.SERVES_MEDIA or not path.startswith(f"""{settings.PODCAST_STORAGE_DIRECTORY}/"""):
+        abort(404)
+    try:
+        file_path = storage.file_path(path)
+    except ValueError:
+        abort(404)
+    if not os.path.isfile(file_path):
+        abort(404)
+    return send_file(file_path, mimetype=storage.content_type(path) or "application/octet-stream",
+                     conditional=True)
+
+
 @app.route('/internal/download-podcast/', methods=["GET", "POST"])
 @require_task_api_key
-def task_recursive_download_podcast():
-    """Fourth and last step in parsing.  Download the content and save it.
-    We make this recursive because the free tier of App Engine limits the
-    length of time a process can run for.  This will (hopefully) allow us
-    to download a greater number of files without running over time limits.
+@instrument_task
+def task_download_podcast():
+    """Third step in parsing.  Refresh the feed and plan the download of every
+    new entry in one pass.  Each entry is downloaded by its own task (see
+    task_download_episode) with at most PODCAST_DOWNLOAD_CONCURRENCY running
+    at once for this podcast; as each one finishes, it starts the next.
+    Also decides when the podcast is next due for a refresh.
     :return: Ok
     """
     data = get_task_arguments()
@@ -257,50 +342,139 @@ def task_recursive_download_podcast():
     podcast_id = data["podcast_id"]
 
     podcast = Podcast.load(user_uid, podcast_id)
-    new_feed = podcast.load_feed()
+    expiration_cutoff = datetime.datetime.utcnow() - datetime.timedelta(settings.EPISODE_EXPIRATION_DAYS)
+    try:
+        new_feed = podcast.load_feed(incremental=True, published_after=expiration_cutoff,
+                                     conditional=True)
+    except FeedNotModified:
+        new_feed = None
+    except Exception:
+        # try again later, backing off while the feed keeps failing
+        app.logger.exception(f"""Could not refresh podcast {user_uid}/{podcast_id}""")
+        schedule_refresh(podcast, FAILED)
+        podcast.save_refresh_state()
+        return OK_RESPONSE
 
-    # update the feed data (e.g. title, image, etc.)
-    podcast.feed.title = new_feed.title
-    podcast.feed.description = new_feed.description
-    podcast.feed.image_url = new_feed.image_url
-    podcast.save()
+    outcome = CHANGED if new_feed is not None and new_feed.entries else UNCHANGED
+    unchanged = new_feed is None or (not new_feed.entries and not podcast.feed.metadata_changed(new_feed))
+    if unchanged and not podcast.pending:
+        # no new entries or channel changes: nothing to write but the parser
+        # state (which may hold refreshed channel info) and the schedule
+        schedule_refresh(podcast, outcome)
+        podcast.save_refresh_state()
+        return OK_RESPONSE
 
-    new_entry = None
-    for e in new_feed.entries:
-        if e not in podcast.feed.entries and e.published + datetime.timedelta(settings.EPISODE_EXPIRATION_DAYS) > \
-                datetime.datetime.utcnow():
-            new_entry = e
-    if new_entry is None:
+    def plan(stored_podcast):
+        # applied to a freshly read copy, in case a download finished meanwhile
+        stored_podcast.parser_state = podcast.parser_state
+        schedule_refresh(stored_podcast, outcome)
+        if new_feed is not None:
+            # the channel's title, description or image may change without new entries
+            stored_podcast.feed.update_metadata(new_feed)
+            stored_podcast.plan_downloads(new_feed.entries, published_after=expiration_cutoff)
+        return stored_podcast.dispatch_downloads(settings.PODCAST_DOWNLOAD_CONCURRENCY)
+
+    dispatched = Podcast.update_in_transaction(user_uid, podcast_id, plan)
+    add_download_tasks(user_uid, podcast_id, dispatched)
+    return OK_RESPONSE
+
+
+@app.route('/internal/download-episode/', methods=["GET", "POST"])
+@require_task_api_key
+@instrument_task
+def task_download_episode():
+    """Last step in parsing.  Download one planned entry, merge it into the
+    feed and dispatch the next pending entry of the same podcast.
+    :return: Ok
+    """
+    data = get_task_arguments()
+    user_uid = data["user_uid"]
+    podcast_id = data["podcast_id"]
+    entry_id = data["entry_id"]
+
+    podcast = Podcast.load(user_uid, podcast_id)
+    entry = podcast.get_pending(entry_id)
+    if entry is None:
+        # already merged by an earlier attempt, or expired while waiting
         return OK_RESPONSE
 
     podcast_type = PODCAST_TYPES[podcast.podcast_type]
     downloader = podcast_type.downloader()
     try:
-        blob = downloader.download(new_entry.link)
+        media = downloader.download(entry.link, MediaIndex.reference(user_uid, podcast_id, entry.id))
         # update the entry to have our location and new
-        new_entry.link = blob.public_url
-        new_entry.bytes = blob.size
-        new_entry.mimetype = blob.content_type
+        entry.link = media.public_url
+        entry.path = media.path
+        entry.bytes = media.size
+        entry.mimetype = media.content_type
     except DownloadException as e:
-        # no ability to download, so keep the original URL and move on.
+        # no ability to download; fail the task so Cloud Tasks retries it.
         raise e
-    # update feed and save (recall feed has pointers to the updated entry)
-    # NOTE: We reload the podcast here before running `save` in case
-    # another task updated this podcast while we were downloading and
-    # writing the blob.
-    if new_entry not in podcast.feed.entries:
-        podcast.feed.insert(new_entry)
-    podcast.feed.last_updated = datetime.datetime.utcnow()
-    podcast.save()
-    # call this task again.  this ensures the system (serially) downloads
-    # all the content for this URL
-    # NOTE: Because we return earlier if no new_entry is found, this ensures
-    # that we only re-queue download tasks in the event of new entries.
-    add_task(url_for("task_recursive_download_podcast"),
-             {"user_uid": user_uid, "podcast_id": podcast_id})
+
+    def merge(stored_podcast):
+        merged = stored_podcast.merge_download(entry)
+        return merged, stored_podcast.dispatch_downloads(settings.PODCAST_DOWNLOAD_CONCURRENCY)
+
+    try:
+        merged, dispatched = Podcast.update_in_transaction(user_uid, podcast_id, merge)
+    except PodcastNotFound:
+        merged, dispatched = False, []
+    if not merged:
+        # the podcast was deleted or re-initialized while downloading, so
+        # nothing will refer to this copy of the media
+        release_entries_media(podcast, [entry])
+    add_download_tasks(user_uid, podcast_id, dispatched)
     return OK_RESPONSE
 
 
+def add_download_tasks(user_uid, podcast_id, dispatched):
+    """Queue a task_download_episode for each dispatched entry.
+
+    :param dispatched: list of (entry_id, task_name) from Podcast.dispatch_downloads
+    """
+    add_tasks((url_for("task_download_episode"),
+               {"user_uid": user_uid, "podcast_id": podcast_id, "entry_id": entry_id},
+               task_name)
+              for entry_id, task_name in dispatched)
+
+
+@app.route('/internal/migrate-podcasts/', methods=["GET", "POST"])
+@require_task_api_key
+@instrument_task
+def task_migrate_podcasts():
+    """Re-save every podcast stored in an older layout: without a shard (or with
+    one from a different PODCAST_SHARD_COUNT), without a refresh schedule, with
+    its entries embedded or listed by id, without an index of its entry ids, or
+    with its pending entries embedded.
+    Run once after upgrading or changing the shard count; podcasts that aren't
+    in the right shard are never refreshed.
+
+    :return: Ok
+    """
+    for document in Podcast.get_all_podcast_documents():
+        dict_ = document.to_dict()
+        podcast = Podcast.from_dict(dict_)
+        if dict_.get("shard") != podcast.shard or "next_check_at" not in dict_ or \
+                "entries" in dict_["feed"] or "entry_ids" in dict_["feed"] or \
+                not podcast.feed.has_entry_index or \
+                any("entry" in pending for pending in dict_.get("pending", [])):
+            if not podcast.feed.has_entry_index:
+                podcast.feed.rebuild_entry_index()
+            podcast.save()
+    return OK_RESPONSE
+
+
+@app.route('/internal/metrics/', methods=["GET", "POST"])
+@require_task_api_key
+def task_metrics():
+    """Timings, bytes moved and operation counts of the tasks this instance
+    has run, in total by task and stage and for the most recent invocations.
+
+    :return: JSON
+    """
+    return jsonify(registry.to_dict())
+
+
 @app.context_processor
 def inject_dict_for_all_templates():
     """Adds variables to the templates for all templates.
@@ -317,11 +491,14 @@ def inject_dict_for_all_templates():
 
 @app.after_request
 def add_header(response):
-    """Alter the response object to include no-cache headers.
+    """Alter the response object to include no-cache headers, unless the view
+    already chose its own caching policy (e.g. the RSS feed).
 
     :param response: The response object for the view being rendered
     :return: an updated response object
     """
+    if "Cache-Control" in response.headers:
+        return response
     response.cache_control.public = True
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     response.headers["Pragma"] = "no-cache"